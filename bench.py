@@ -0,0 +1,422 @@
+# OFFLINE LOAD TEST – FAKE TELEGRAM, RESOLVER AND CDN
+#
+# Runs javacoder.py against local stand-in servers and replays N users through
+# /genny, DM links and tg_ button presses:
+#
+#   python bench.py --users 50 --file-mb 20 --cdn-rate-mb 8
+#
+# Bot settings (MAX_TRANSFERS, DOWNLOAD_SEGMENTS, PIPELINE_UPLOADS, ...) are read
+# from the environment as usual, so runs can be compared setting by setting.
+# Uploads are streamed as multipart bodies like against api.telegram.org;
+# --local-bot-api benchmarks a self-hosted server in local mode instead.
+
+import os, sys, time, json, random, asyncio, argparse, tempfile, resource, socket, statistics
+from datetime import datetime
+from urllib.parse import urlparse, unquote
+from aiohttp import web
+
+BENCH_TOKEN = "123456:BENCH"
+BENCH_GROUP_BASE = -1009000000000  # /genny users each get their own allowed group
+CDN_BLOCK = b"\0" * (256 * 1024)
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def format_mb(size_bytes):
+    return f"{size_bytes / (1024 * 1024):.1f} MB"
+
+# ---------- FAKE RESOLVER ----------
+def create_resolver_app(cdn_url, file_size, latency, failure_rate):
+    """Answers like API_BASE after ~latency seconds, failing failure_rate of the time"""
+    async def resolve(request):
+        await asyncio.sleep(random.expovariate(1 / latency) if latency else 0)
+        if random.random() < failure_rate:
+            return web.Response(status=502, text="upstream error")
+        link = request.query.get("link", "")
+        name = link.rstrip("/").rsplit("/", 1)[-1]
+        return web.json_response({"data": [{
+            "download": f"{cdn_url}/file/{name}.mp4?size={file_size}",
+            "title": f"Bench {name}",
+            "size": format_mb(file_size),
+        }]})
+
+    app = web.Application()
+    app.router.add_get("/", resolve)
+    return app
+
+# ---------- FAKE CDN ----------
+def create_cdn_app(rate):
+    """Serves ?size= bytes of zeros with Range support, throttled to rate bytes/s per connection"""
+    def parse_range(header, size):
+        start, _, end = header.replace("bytes=", "").partition("-")
+        start = int(start or 0)
+        end = min(int(end), size - 1) if end else size - 1
+        return start, end
+
+    async def serve(request):
+        size = int(request.query.get("size", "0"))
+        headers = {"Accept-Ranges": "bytes", "ETag": f'"{request.match_info["name"]}-{size}"'}
+        start, end, status = 0, size - 1, 200
+        if "Range" in request.headers:
+            start, end = parse_range(request.headers["Range"], size)
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+
+        if request.method == "HEAD":
+            return web.Response(status=status, headers=headers)
+
+        resp = web.StreamResponse(status=status, headers=headers)
+        await resp.prepare(request)
+        remaining = end - start + 1
+        started = time.monotonic()
+        sent = 0
+        while remaining > 0:
+            chunk = CDN_BLOCK[:min(len(CDN_BLOCK), remaining)]
+            await resp.write(chunk)
+            remaining -= len(chunk)
+            sent += len(chunk)
+            if rate:
+                # Sleep until this connection is back under its rate
+                ahead = sent / rate - (time.monotonic() - started)
+                if ahead > 0:
+                    await asyncio.sleep(ahead)
+        await resp.write_eof()
+        return resp
+
+    app = web.Application()
+    app.router.add_route("GET", "/file/{name}", serve)
+    app.router.add_route("HEAD", "/file/{name}", serve)
+    return app
+
+# ---------- FAKE BOT API ----------
+class FakeBotAPI:
+    """Minimal Bot API: every call succeeds, and bot output is turned into driver events"""
+
+    def __init__(self):
+        self.next_message_id = 1000
+        self.calls = {}
+        self.upload_bytes = 0
+        self.waiters = {}  # (chat_id, event) -> Future
+
+    def wait_for(self, chat_id, event):
+        return self.waiters.setdefault((chat_id, event), asyncio.get_running_loop().create_future())
+
+    def _notify(self, chat_id, event, value):
+        future = self.waiters.setdefault((chat_id, event), asyncio.get_running_loop().create_future())
+        if not future.done():
+            future.set_result(value)
+
+    def _message(self, chat_id, message_id=None, **extra):
+        if message_id is None:
+            self.next_message_id += 1
+            message_id = self.next_message_id
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            **extra,
+        }
+
+    async def _read_params(self, request):
+        """Return form/JSON params; uploaded files are counted and discarded"""
+        params = {}
+        if request.content_type.startswith("multipart/"):
+            reader = await request.multipart()
+            async for part in reader:
+                if part.filename:
+                    while chunk := await part.read_chunk(1024 * 1024):
+                        self.upload_bytes += len(chunk)
+                    params[part.name] = part.filename
+                else:
+                    params[part.name] = await part.text()
+        elif request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        return params
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = await self._read_params(request)
+        chat_id = str(params.get("chat_id", ""))
+        chat_id = int(chat_id) if chat_id.lstrip("-").isdigit() else chat_id  # "@channel" for getChatMember
+        text = params.get("text", "")
+
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method == "getChatMember":
+            user_id = int(params["user_id"])
+            result = {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": f"u{user_id}"}}
+        elif method == "sendVideo":
+            video = params.get("video", "")
+            if video.startswith("file://"):
+                # Local mode: the bot hands over a path instead of bytes
+                self.upload_bytes += os.path.getsize(unquote(urlparse(video).path))
+            media = {"file_id": f"bench-{self.next_message_id}", "file_unique_id": f"u{self.next_message_id}",
+                     "width": 1280, "height": 720, "duration": 60}
+            result = self._message(chat_id, video=media)
+            self._notify(chat_id, "video", time.monotonic())
+        elif method in ("sendMessage", "editMessageText"):
+            message_id = int(params["message_id"]) if "message_id" in params else None
+            extra = {"text": text}
+            if params.get("reply_markup"):
+                extra["reply_markup"] = json.loads(params["reply_markup"])
+            result = self._message(chat_id, message_id, **extra)
+            if "Download Ready" in text:
+                self._notify(chat_id, "ready", result)
+            elif text.startswith("❌"):
+                self._notify(chat_id, "ready", None)
+                self._notify(chat_id, "video", None)
+        elif method.startswith(("send", "copy", "forward")):
+            result = self._message(chat_id)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def create_app(self):
+        app = web.Application(client_max_size=1024 ** 4)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+async def start_site(app, port):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+# ---------- DRIVER ----------
+def make_user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"User{uid}", "username": f"user{uid}"}
+
+class Driver:
+    """Feeds synthetic updates into the application and times the replies"""
+
+    def __init__(self, app, bot_api, bot):
+        self.app = app
+        self.bot_api = bot_api
+        self.bot = bot
+        self.next_update_id = 1
+        self.updates = 0
+        self.ready_times = []
+        self.transfer_times = []
+        self.failures = {"resolve": 0, "transfer": 0}
+
+    async def push(self, data):
+        from telegram import Update
+        data["update_id"] = self.next_update_id
+        self.next_update_id += 1
+        self.updates += 1
+        await self.app.update_queue.put(Update.de_json(data, self.bot))
+
+    async def run_user(self, uid, use_genny, press, timeout):
+        chat_id = BENCH_GROUP_BASE - uid if use_genny else uid
+        chat = {"id": chat_id, "type": "supergroup" if use_genny else "private"}
+        link = f"https://terabox.com/s/1bench{uid}x{random.getrandbits(32):08x}"
+        text = f"/genny {link}" if use_genny else link
+        entities = [{"type": "bot_command", "offset": 0, "length": 6}] if use_genny else []
+
+        ready = self.bot_api.wait_for(chat_id, "ready")
+        started = time.monotonic()
+        await self.push({"message": {
+            "message_id": uid, "date": int(time.time()), "chat": chat,
+            "from": make_user(uid), "text": text, "entities": entities,
+        }})
+        try:
+            message = await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
+            message = None
+        if message is None:
+            self.failures["resolve"] += 1
+            return
+        self.ready_times.append(time.monotonic() - started)
+        if not press:
+            return
+
+        video = self.bot_api.wait_for(chat_id, "video")
+        started = time.monotonic()
+        await self.push({"callback_query": {
+            "id": str(uid), "from": make_user(uid), "chat_instance": str(chat_id),
+            "message": message, "data": f"tg_{uid}",
+        }})
+        try:
+            done = await asyncio.wait_for(video, timeout)
+        except asyncio.TimeoutError:
+            done = None
+        if done is None:
+            self.failures["transfer"] += 1
+            return
+        self.transfer_times.append(done - started)
+
+async def sample_disk(path, peak):
+    while True:
+        peak[0] = max(peak[0], dir_size(path))
+        await asyncio.sleep(0.2)
+
+async def run_bench(args, workdir):
+    bot_api = FakeBotAPI()
+    ports = {name: free_port() for name in ("bot", "cdn")}
+    resolver_ports = [free_port() for _ in range(args.resolvers)]
+    cdn_url = f"http://127.0.0.1:{ports['cdn']}"
+    file_size = int(args.file_mb * 1024 * 1024)
+
+    runners = [
+        await start_site(bot_api.create_app(), ports["bot"]),
+        await start_site(create_cdn_app(int(args.cdn_rate_mb * 1024 * 1024)), ports["cdn"]),
+    ]
+    for port in resolver_ports:
+        resolver = create_resolver_app(cdn_url, file_size, args.resolver_latency, args.resolver_failure)
+        runners.append(await start_site(resolver, port))
+
+    # The bot reads its configuration at import time. By default the fake is a
+    # plain Bot API endpoint, so videos go through the streamed multipart upload;
+    # --local-bot-api switches to local mode, where only file:// paths are sent.
+    bot_api_url = f"http://127.0.0.1:{ports['bot']}"
+    for name in ("LOCAL_BOT_API_URL", "BOT_API_URL", "REDIS_URL"):
+        os.environ.pop(name, None)
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "API_BASE": f"http://127.0.0.1:{resolver_ports[0]}/",
+        "RESOLVER_ENDPOINTS": ",".join(f"http://127.0.0.1:{port}/" for port in resolver_ports),
+        "LOCAL_BOT_API_URL" if args.local_bot_api else "BOT_API_URL": bot_api_url,
+        "UPLOAD_LIMIT_MB": os.environ.get("UPLOAD_LIMIT_MB", "2000"),  # the fake takes any size
+        "USER_DB_PATH": os.path.join(workdir, "bench_users.db"),
+        "PARTIAL_DIR": os.path.join(workdir, "partial"),
+        "METRICS_PORT": os.environ.get("METRICS_PORT", "0"),
+        "BOT_MODE": "polling",
+    })
+    import javacoder
+
+    for uid in range(1, args.users + 1):
+        javacoder.ALLOWED_GROUPS[BENCH_GROUP_BASE - uid] = f"Bench Group {uid}"
+    javacoder.load_user_data()
+
+    app = javacoder.build_application()
+    await app.initialize()
+    await javacoder.post_init(app)
+    await app.start()
+
+    driver = Driver(app, bot_api, app.bot)
+    peak_disk = [0]
+    disk_task = asyncio.create_task(sample_disk(workdir, peak_disk))
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(f"🚀 {args.users} users | {args.file_mb} MB files | CDN {args.cdn_rate_mb} MB/s per connection | "
+          f"{args.resolvers} resolver(s) {args.resolver_latency}s, {args.resolver_failure:.0%} failures | "
+          f"{'local' if args.local_bot_api else 'multipart'} uploads")
+    started = time.monotonic()
+    await asyncio.gather(*(
+        driver.run_user(
+            uid,
+            use_genny=(args.mode == "genny" or (args.mode == "mixed" and uid % 2 == 0)),
+            press=random.random() < args.press_ratio,
+            timeout=args.timeout,
+        )
+        for uid in range(1, args.users + 1)
+    ))
+    elapsed = time.monotonic() - started
+
+    disk_task.cancel()
+    await app.stop()
+    await app.shutdown()
+    await javacoder.post_shutdown(app)
+    for runner in runners:
+        await runner.cleanup()
+
+    transfers = len(driver.transfer_times)
+    moved = bot_api.upload_bytes
+    return {
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "users": args.users,
+        "uploads": "local" if args.local_bot_api else "multipart",
+        "updates": driver.updates,
+        "elapsed": round(elapsed, 2),
+        "updates_per_sec": round(driver.updates / elapsed, 2),
+        "ready_p50": round(percentile(driver.ready_times, 50), 3),
+        "ready_p99": round(percentile(driver.ready_times, 99), 3),
+        "transfers": transfers,
+        "transfer_p50": round(percentile(driver.transfer_times, 50), 2),
+        "transfer_p99": round(percentile(driver.transfer_times, 99), 2),
+        "upload_bytes": moved,
+        "throughput_mb_s": round(moved / elapsed / (1024 * 1024), 2),
+        "per_transfer_mb_s": round(statistics.mean(file_size / t for t in driver.transfer_times) / (1024 * 1024), 2) if transfers else 0,
+        "failures": driver.failures,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "rss_before_mb": round(rss_before / 1024, 1),
+        "peak_disk_mb": round(peak_disk[0] / (1024 * 1024), 1),
+        "bot_api_calls": bot_api.calls,
+    }
+
+def print_report(result):
+    print("=" * 60)
+    print("📊 **BENCHMARK RESULTS**")
+    print("=" * 60)
+    print(f"👥 Users: {result['users']} | Uploads: {result['uploads']} | Updates: {result['updates']} in {result['elapsed']}s")
+    print(f"⚡ Updates/sec: {result['updates_per_sec']}")
+    print(f"✅ Time to Download Ready: p50 {result['ready_p50']}s | p99 {result['ready_p99']}s")
+    print(f"🎬 Transfers: {result['transfers']} | p50 {result['transfer_p50']}s | p99 {result['transfer_p99']}s")
+    print(f"📈 Throughput: {result['throughput_mb_s']} MB/s total | {result['per_transfer_mb_s']} MB/s per transfer")
+    print(f"❌ Failures: {result['failures']['resolve']} resolve | {result['failures']['transfer']} transfer")
+    print(f"🧠 Peak RSS: {result['peak_rss_mb']} MB (fakes included; {result['rss_before_mb']} MB before the run)")
+    print(f"💾 Peak Disk: {result['peak_disk_mb']} MB")
+    print(f"📡 Bot API calls: {result['bot_api_calls']}")
+    print("=" * 60)
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for javacoder.py")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--mode", choices=("mixed", "genny", "dm"), default="mixed", help="how users send their link")
+    parser.add_argument("--press-ratio", type=float, default=1.0, help="share of users who press the Telegram download button")
+    parser.add_argument("--file-mb", type=float, default=10)
+    parser.add_argument("--cdn-rate-mb", type=float, default=10, help="CDN speed per connection, 0 for unthrottled")
+    parser.add_argument("--resolvers", type=int, default=1, help="number of fake resolver endpoints")
+    parser.add_argument("--resolver-latency", type=float, default=0.3, help="mean resolver latency in seconds")
+    parser.add_argument("--resolver-failure", type=float, default=0.1, help="share of resolver requests that fail")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for each reply")
+    parser.add_argument("--local-bot-api", action="store_true",
+                        help="run the bot in local mode (file:// paths) instead of streamed multipart uploads")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--json", metavar="PATH", help="append the result as one JSON line to PATH")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="terabox_bench_") as workdir:
+        # Temp files, partials and the save group spill file all stay in workdir
+        os.environ["TMPDIR"] = workdir
+        tempfile.tempdir = None
+        os.chdir(workdir)
+        try:
+            result = asyncio.run(run_bench(args, workdir))
+        finally:
+            os.chdir(cwd)
+
+    print_report(result)
+    if args.json:
+        with open(args.json, "a") as f:
+            f.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main()
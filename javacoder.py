@@ -1,18 +1,27 @@
 # TERABOX GROUP BOT – DIRECT + TG DOWNLOAD WITH PROGRESS
 
-import requests, time, os, tempfile, asyncio, random, math, json
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+import time, os, tempfile, asyncio, random, math, json, re, sqlite3, hashlib, shutil, threading, signal, secrets
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from abc import ABC, abstractmethod
+from urllib.parse import urlparse, parse_qs
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message, CallbackQuery
 from telegram.ext import ApplicationBuilder, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+from telegram.ext import BaseUpdateProcessor, CallbackContext
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter, BadRequest, NetworkError
+from telegram.request import HTTPXRequest
 import aiohttp
 import aiofiles
+from aiohttp import web
 from datetime import datetime
+from pathlib import Path
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     logger.error("❌ BOT_TOKEN not found!")
     sys.exit(1)
-API_BASE = "https://teradl.tiiny.io/"
+API_BASE = os.getenv("API_BASE", "https://teradl.tiiny.io/")
 
 # Channel and group for mandatory subscription
 CHANNEL_USERNAME = "@NetFusionTG"
@@ -28,12 +37,127 @@ ALLOWED_GROUPS = {
 # Special group for saving user info and links (-1003648617588)
 SAVE_GROUP_ID = -1003648617588
 
+# Save group messages are sent by a background worker (Telegram allows ~20/min per group)
+SAVE_QUEUE_SIZE = 500
+SAVE_RATE = 20 / 60  # messages per second
+SAVE_BURST = 3
+SAVE_SEND_ATTEMPTS = 3
+SAVE_SPILL_PATH = "save_group_spill.jsonl"  # overflow backlog, replayed when the queue drains
+
+# Digest mode: collect save group entries and post them as one message/document
+SAVE_DIGEST = os.getenv("SAVE_DIGEST", "0") == "1"
+SAVE_DIGEST_WINDOW = int(os.getenv("SAVE_DIGEST_WINDOW", "60"))  # seconds
+SAVE_DIGEST_MAX = int(os.getenv("SAVE_DIGEST_MAX", "20"))  # entries per digest
+SAVE_DIGEST_INLINE = 5  # bigger digests are attached as a JSONL document
+
 COOLDOWN = 30
 
-# Data storage
-user_last = {}
-sessions = {}
+# Bulk mode: /batch or a DM with several links, resolved concurrently into one reply
+BATCH_MAX_LINKS = int(os.getenv("BATCH_MAX_LINKS", "50"))  # Telegram allows 100 buttons, two per file
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "5"))  # links of one batch resolved at once
+
+# Update delivery: "polling" (default) or "webhook" (served by aiohttp)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # public base URL; setWebhook is skipped if empty
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # required; generated per run if empty and WEBHOOK_URL is set
+WEBHOOK_MAX_CONNECTIONS = 40  # parallel connections Telegram may open to us
+PORT = int(os.getenv("PORT", "8080"))
+
+# Updates are processed concurrently, but each user's updates stay in order
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+
+# Link resolver settings
+RESOLVE_RETRIES = 5
+RESOLVE_TIMEOUT = 15  # seconds per attempt
+# Comma-separated API_BASE-compatible endpoints, tried healthiest first
+RESOLVER_ENDPOINTS = [url.strip() for url in os.getenv("RESOLVER_ENDPOINTS", API_BASE).split(",") if url.strip()]
+HEDGE_DEFAULT_DELAY = 3  # seconds before hedging while an endpoint has few samples
+HEDGE_MIN_DELAY = 0.25  # never hedge sooner than this
+HEDGE_MIN_SAMPLES = 20  # latencies needed before the endpoint's own p95 is used
+BREAKER_FAILURES = 5  # consecutive failures that open an endpoint's circuit
+BREAKER_COOLDOWN = 30  # seconds an open circuit fails fast before a half-open probe
+
+# Resolved link cache (direct links stay valid for a few hours)
+LINK_CACHE_TTL = int(os.getenv("LINK_CACHE_TTL", "7200"))
+LINK_NEGATIVE_TTL = int(os.getenv("LINK_NEGATIVE_TTL", "120"))
+LINK_CACHE_SIZE = int(os.getenv("LINK_CACHE_SIZE", "2000"))
+
+# Downloads: large files are fetched as parallel byte ranges when the CDN allows it
+DOWNLOAD_SEGMENTS = int(os.getenv("DOWNLOAD_SEGMENTS", "4"))
+SEGMENT_MIN_SIZE = 8 * 1024 * 1024  # don't split into segments smaller than this
+SEGMENT_RETRIES = 3
+DOWNLOAD_CHUNK_SIZE = 1024 * 512
+
+# Partial downloads are kept with a state sidecar so they can be resumed
+PARTIAL_DIR = os.getenv("PARTIAL_DIR", os.path.join(tempfile.gettempdir(), "terabox_partial"))
+PARTIAL_MAX_AGE = 6 * 3600  # seconds before abandoned partials are deleted
+PARTIAL_CHECKPOINT = 2  # seconds between sidecar writes
+
+# Self-hosted telegram-bot-api server: local mode sends file:// paths instead of bytes
+LOCAL_BOT_API_URL = os.getenv("LOCAL_BOT_API_URL", "").rstrip("/")  # e.g. http://localhost:8081
+# Other Bot API endpoint (proxy, test server) used without local mode; files are still uploaded
+BOT_API_URL = os.getenv("BOT_API_URL", "").rstrip("/")
+UPLOAD_LIMIT_MB = int(os.getenv("UPLOAD_LIMIT_MB", "2000" if LOCAL_BOT_API_URL else "50"))
+
+# Pipelined transfers stream the download straight into the upload (no temp file)
+PIPELINE_UPLOADS = os.getenv("PIPELINE_UPLOADS", "0") == "1"
+PIPELINE_BUFFER_CHUNKS = 32  # chunks of DOWNLOAD_CHUNK_SIZE buffered between download and upload
+
+# Progress message edits share one budget (Telegram allows ~1 edit/s per chat, ~30 calls/s overall)
+PROGRESS_EDITS_PER_SEC = 10
+PROGRESS_MIN_INTERVAL = 2  # seconds between edits of the same message
+
+# Transfer scheduler (download + upload slots)
+MAX_TRANSFERS = int(os.getenv("MAX_TRANSFERS", "3"))
+MAX_TRANSFERS_PER_USER = int(os.getenv("MAX_TRANSFERS_PER_USER", "1"))
+DISK_RESERVE = 512 * 1024 * 1024  # temp space always left free
+
+# Subscription check cache (members are re-checked after the TTL)
+SUB_CACHE_TTL = 300
+SUB_NEGATIVE_TTL = 30
+SUB_CACHE_SIZE = 10000
+
+# Shared state backend: in-process by default, Redis when REDIS_URL is set (multi-worker)
+REDIS_URL = os.getenv("REDIS_URL", "")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "terabox:")
+
+# Prometheus text metrics, served on a local port (0 disables)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9090"))
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+TRANSFER_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800)
+metrics_runner = None
+
+# Data storage (sessions and cooldowns are TTLCaches, created below)
 user_data = {}
+SESSION_LIMIT = 10000
+COOLDOWN_LIMIT = 50000
+SWEEP_INTERVAL = 60  # seconds between expiry sweeps
+
+# User store (SQLite in WAL mode, written in batches off the event loop)
+USER_DB_PATH = os.getenv("USER_DB_PATH", "user_data.db")
+USER_JSON_PATH = "user_data.json"  # legacy store, migrated once
+USER_FLUSH_INTERVAL = 5  # seconds between batched commits
+user_db = None
+user_db_lock = threading.Lock()
+pending_users = {}  # user_id -> record waiting for the next commit
+
+# Recent transfer throughput, to tell CDN and Telegram bottlenecks apart
+THROUGHPUT_HISTORY = 100
+transfer_log = deque(maxlen=THROUGHPUT_HISTORY)  # (kind, bytes, seconds)
+
+# Telegram file_id of every uploaded video, keyed by normalized share link
+video_ids = {}
+background_tasks = []
+
+# Shared HTTP client for resolver, probe and download traffic (opened in post_init)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "100"))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", "16"))
+HTTP_DNS_TTL = 300  # seconds
+HTTP_KEEPALIVE = 60  # seconds an idle connection stays open
+http_session = None
+http_stats = {'requests': 0, 'new_connections': 0, 'reused_connections': 0, 'dns_hits': 0, 'dns_misses': 0}
 
 CREDIT = (
     "╔══════════════════════╗\n"
@@ -45,10 +169,725 @@ CREDIT = (
     "╚══════════════════════╝"
 )
 
+# ---------- METRICS ----------
+class Metric:
+    """Base for counters, gauges and histograms in the Prometheus text format.
+    
+    Values are kept per label tuple. Passing fn makes the metric read its
+    value(s) at scrape time instead: fn returns a number, or a dict of
+    label tuple -> number.
+    """
+    
+    kind = "untyped"
+    
+    def __init__(self, name, help_text, labels=(), fn=None):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.fn = fn
+        self.values = {}
+        metrics_registry.append(self)
+    
+    def _labels(self, label_values):
+        return tuple(str(label_values[name]) for name in self.labels)
+    
+    @staticmethod
+    def _format(names, values, extra=""):
+        pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+    
+    def samples(self):
+        values = self.values
+        if self.fn is not None:
+            result = self.fn()
+            values = result if isinstance(result, dict) else {(): result}
+        for label_values, value in values.items():
+            yield f"{self.name}{self._format(self.labels, label_values)} {value}"
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+    
+    def inc(self, amount=1, **labels):
+        key = self._labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+    
+    def set(self, value, **labels):
+        self.values[self._labels(labels)] = value
+    
+    def inc(self, amount=1, **labels):
+        key = self._labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+    
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+    
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+    
+    def observe(self, value, **labels):
+        key = self._labels(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            # Per-bucket (non-cumulative) counts, then sum and count
+            entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += value
+        entry[2] += 1
+    
+    @contextmanager
+    def time(self, **labels):
+        """Observe how long the with-block took (also when it raises)"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+    
+    def _bucket(self, label_values, bound, count):
+        le = f'le="{bound}"'
+        return f"{self.name}_bucket{self._format(self.labels, label_values, le)} {count}"
+    
+    def samples(self):
+        for label_values, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield self._bucket(label_values, bound, cumulative)
+            yield self._bucket(label_values, "+Inf", count)
+            yield f"{self.name}_sum{self._format(self.labels, label_values)} {total}"
+            yield f"{self.name}_count{self._format(self.labels, label_values)} {count}"
+
+metrics_registry = []
+
+def render_metrics():
+    return "\n".join(metric.render() for metric in metrics_registry) + "\n"
+
+def recent_throughput():
+    """Average bytes/s per transfer kind over transfer_log"""
+    totals = {}
+    for kind, size_bytes, seconds in transfer_log:
+        moved, spent = totals.get((kind,), (0, 0))
+        totals[(kind,)] = (moved + size_bytes, spent + seconds)
+    return {kind: moved / spent for kind, (moved, spent) in totals.items()}
+
+resolve_seconds = Histogram("terabox_resolve_seconds", "Time to resolve a share link, all attempts included", ("outcome",))
+resolver_request_seconds = Histogram("terabox_resolver_request_seconds", "Latency of single resolver requests", ("endpoint", "outcome"))
+resolver_hedges = Counter("terabox_resolver_hedges_total", "Hedged resolver requests by the endpoint they went to", ("endpoint",))
+resolver_fast_fails = Counter("terabox_resolver_fast_fails_total", "Resolve attempts skipped because every circuit was open")
+telegram_request_seconds = Histogram("terabox_telegram_request_seconds", "Bot API call latency (getChatMember, sendMessage, editMessageText, sendVideo, ...)", ("method",))
+telegram_errors = Counter("terabox_telegram_errors_total", "Bot API calls that raised or returned an error", ("method",))
+transfer_seconds = Histogram("terabox_transfer_seconds", "Duration of finished downloads and uploads", ("kind",), buckets=TRANSFER_BUCKETS)
+transfer_bytes = Counter("terabox_transfer_bytes_total", "Bytes moved by finished transfers", ("kind",))
+retries = Counter("terabox_retries_total", "Retried operations", ("operation",))
+
+Gauge("terabox_throughput_bytes_per_second", "Average throughput of recent transfers", ("kind",), fn=recent_throughput)
+Gauge("terabox_transfers_active", "Transfers holding a scheduler slot", fn=lambda: len(transfer_scheduler.active))
+Gauge("terabox_transfers_waiting", "Transfers waiting for a scheduler slot", fn=lambda: transfer_scheduler.waiting)
+Counter("terabox_transfers_completed_total", "Transfers that released their slot", fn=lambda: transfer_scheduler.completed)
+Gauge("terabox_queue_depth", "Items waiting in internal queues", ("queue",), fn=lambda: {
+    ("save_group",): save_queue.queue.qsize(),
+    ("progress_edits",): len(progress_renderer.pending),
+    ("resolves_inflight",): len(inflight_resolves),
+})
+Counter("terabox_save_group_messages_total", "Save group messages by outcome", ("result",), fn=lambda: {
+    ("sent",): save_queue.sent,
+    ("failed",): save_queue.failed,
+    ("spilled",): save_queue.spilled,
+    ("dropped",): save_queue.dropped,
+})
+Counter("terabox_progress_edits_total", "Progress message edits by outcome", ("result",), fn=lambda: {
+    ("sent",): progress_renderer.edits,
+    ("skipped",): progress_renderer.skipped,
+    ("flood_wait",): progress_renderer.flood_waits,
+})
+Counter("terabox_link_cache_lookups_total", "Resolved link cache lookups", ("result",), fn=lambda: {
+    ("hit",): link_stats['hits'],
+    ("miss",): link_stats['misses'],
+})
+Gauge("terabox_resolver_circuit_open", "1 while an endpoint's circuit is open or half-open", ("endpoint",), fn=lambda: {
+    (endpoint.name,): int(endpoint.state != "closed") for endpoint in resolver_pool.endpoints
+})
+Gauge("terabox_http_connections", "Shared aiohttp pool connections", ("state",), fn=lambda: dict(zip([("in_use",), ("idle",)], http_pool_stats())))
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest that records the latency of every Bot API call by method"""
+    
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        with telegram_request_seconds.time(method=api_method):
+            try:
+                code, payload = await super().do_request(url, method, *args, **kwargs)
+            except Exception:
+                telegram_errors.inc(method=api_method)
+                raise
+        if code >= 400:
+            telegram_errors.inc(method=api_method)
+        return code, payload
+
+async def start_metrics_server():
+    """Serve render_metrics() on METRICS_HOST:METRICS_PORT/metrics"""
+    global metrics_runner
+    if not METRICS_PORT:
+        return
+    
+    async def handle_metrics(request):
+        return web.Response(text=render_metrics(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+    
+    web_app = web.Application()
+    web_app.router.add_get("/metrics", handle_metrics)
+    metrics_runner = web.AppRunner(web_app)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    print(f"📊 Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def stop_metrics_server():
+    global metrics_runner
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    metrics_runner = None
+
+# ---------- CACHE ----------
+class TTLCache:
+    """Size-bounded LRU mapping whose entries expire after a TTL"""
+    
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+    
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is not None and item[0] <= time.monotonic():
+            del self._data[key]
+            item = None
+        if item is None:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+    
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        if item is None or item[0] <= time.monotonic():
+            return default
+        return item[1]
+    
+    def ttl_left(self, key):
+        """Seconds until key expires, or 0 if it is missing/expired"""
+        item = self._data.get(key)
+        return max(0, item[0] - time.monotonic()) if item else 0
+    
+    def expire(self):
+        """Drop every expired entry"""
+        now = time.monotonic()
+        for key in [key for key, (expires_at, _) in self._data.items() if expires_at <= now]:
+            del self._data[key]
+    
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and item[0] > time.monotonic()
+    
+    def __len__(self):
+        return len(self._data)
+
+class TokenBucket:
+    """Rate limiter allowing `rate` operations per second with bursts of `burst`"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+    
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def pause(self, seconds):
+        """Hold every caller back for `seconds` (e.g. after a flood wait)"""
+        self.tokens = 0
+        self.updated = time.monotonic() + seconds
+
+class ProgressRenderer:
+    """Central, rate-limited editor for progress messages.
+    
+    Only the latest text per message is kept. Edits are flushed under a
+    global budget that halves on every RetryAfter and recovers slowly,
+    and edits that wouldn't change the rendered text are skipped.
+    finish() waits for an edit already on its way to Telegram, and
+    progress queued before finish() is never sent after it.
+    """
+    
+    def __init__(self, max_rate, min_interval):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.min_interval = min_interval
+        self.pending = OrderedDict()  # (chat_id, message_id) -> (message, text, epoch)
+        self.shown = {}  # (chat_id, message_id) -> (text, monotonic time of edit)
+        self.epochs = {}  # (chat_id, message_id) -> number of finish() calls so far
+        self.locks = {}  # (chat_id, message_id) -> Lock held while that message is being edited
+        self.busy = {}  # (chat_id, message_id) -> run()/finish() calls holding or waiting for its lock
+        self.blocked_until = 0
+        self.edits = 0
+        self.skipped = 0
+        self.flood_waits = 0
+    
+    @staticmethod
+    def _key(message):
+        return message.chat.id, message.message_id
+    
+    def _lock(self, key):
+        return self.locks.setdefault(key, asyncio.Lock())
+    
+    def _enter(self, key):
+        self.busy[key] = self.busy.get(key, 0) + 1
+    
+    def _leave(self, key):
+        self.busy[key] -= 1
+        if not self.busy[key]:
+            del self.busy[key]
+    
+    def _release(self, key):
+        """Forget a finished message once nothing queued or in flight refers to it.
+        
+        Its epoch can start over then: no stale text for it is left anywhere.
+        """
+        if key in self.pending or key in self.busy:
+            return
+        self.epochs.pop(key, None)
+        self.locks.pop(key, None)
+    
+    def update(self, message, text):
+        """Record the latest progress text; it is sent when the budget allows"""
+        key = self._key(message)
+        if key in self.shown and self.shown[key][0] == text:
+            self.pending.pop(key, None)
+            self.skipped += 1
+            return
+        self.pending[key] = (message, text, self.epochs.get(key, 0))
+    
+    async def finish(self, message, text=None, **kwargs):
+        """Drop queued progress for message, then optionally edit it right away"""
+        key = self._key(message)
+        # Progress recorded before this point is stale from now on, even if
+        # run() has already taken it off the queue
+        self.epochs[key] = self.epochs.get(key, 0) + 1
+        self.pending.pop(key, None)
+        self.shown.pop(key, None)
+        if text is None:
+            self._release(key)
+            return
+        self._enter(key)
+        try:
+            # Wait for an edit that is already in flight so it can't land after ours
+            async with self._lock(key):
+                for attempt in range(3):
+                    try:
+                        return await message.edit_text(text, **kwargs)
+                    except RetryAfter as e:
+                        self._flood_wait(e.retry_after)
+                        if attempt == 2:
+                            raise
+                        await asyncio.sleep(e.retry_after)
+        finally:
+            self._leave(key)
+            self._release(key)
+    
+    def _flood_wait(self, seconds):
+        self.flood_waits += 1
+        self.blocked_until = time.monotonic() + seconds
+        self.rate = max(0.5, self.rate / 2)
+    
+    def _next_ready(self, now):
+        for key in self.pending:
+            shown = self.shown.get(key)
+            if shown is None or now - shown[1] >= self.min_interval:
+                return key
+        return None
+    
+    def _forget_idle(self, now):
+        """Forget messages that haven't been touched for a while"""
+        cutoff = now - 600
+        self.shown = {k: v for k, v in self.shown.items() if v[1] >= cutoff}
+        idle = [
+            key for key, lock in self.locks.items()
+            if key not in self.shown and key not in self.pending and not lock.locked()
+        ]
+        for key in idle:
+            del self.locks[key]
+        self.epochs = {k: v for k, v in self.epochs.items() if k in self.shown or k in self.pending or k in self.locks}
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(1 / self.rate)
+            now = time.monotonic()
+            if now < self.blocked_until:
+                continue
+            
+            key = self._next_ready(now)
+            if key is None:
+                continue
+            message, text, epoch = self.pending.pop(key)
+            
+            self._enter(key)
+            try:
+                async with self._lock(key):
+                    if self.epochs.get(key, 0) != epoch:
+                        # finish() ran while we waited; this text is stale
+                        continue
+                    try:
+                        await message.edit_text(text)
+                        self.edits += 1
+                        self.rate = min(self.max_rate, self.rate + 0.1)
+                    except RetryAfter as e:
+                        print(f"⏳ Progress edits flood wait: {e.retry_after}s")
+                        self._flood_wait(e.retry_after)
+                        self.pending.setdefault(key, (message, text, epoch))
+                        continue
+                    except BadRequest as e:
+                        # "Message is not modified" still means the text is on screen
+                        if "not modified" not in str(e).lower():
+                            continue
+                    except Exception as e:
+                        print(f"Progress edit failed: {e}")
+                        continue
+                    if self.epochs.get(key, 0) == epoch:
+                        self.shown[key] = (text, now)
+            finally:
+                self._leave(key)
+                if self.epochs.get(key, 0) != epoch:
+                    # Finished meanwhile; finish() left the cleanup to us
+                    self._release(key)
+            
+            if len(self.shown) > 1000:
+                self._forget_idle(now)
+
+progress_renderer = ProgressRenderer(PROGRESS_EDITS_PER_SEC, PROGRESS_MIN_INTERVAL)
+
+link_cache = TTLCache(LINK_CACHE_SIZE, LINK_CACHE_TTL)
+inflight_resolves = {}  # normalized link -> asyncio.Task
+subscription_cache = TTLCache(SUB_CACHE_SIZE, SUB_CACHE_TTL)
+
+# Sessions live as long as their direct link, cooldown entries for COOLDOWN seconds
+sessions = TTLCache(SESSION_LIMIT, LINK_CACHE_TTL)
+user_last = TTLCache(COOLDOWN_LIMIT, COOLDOWN)
+
+link_stats = {'hits': 0, 'misses': 0}
+
+# ---------- STATE BACKEND ----------
+class StateBackend(ABC):
+    """Storage for state that several workers must share.
+    
+    Covers cooldowns, tg_ sessions, the resolved link cache and user records.
+    Backends that can also hand Telegram transfers between workers
+    implement TransferQueue as well.
+    """
+    
+    @abstractmethod
+    async def acquire_cooldown(self, user_id, seconds):
+        """Atomically start a cooldown; False if the user is still cooling down"""
+    
+    @abstractmethod
+    async def set_session(self, key, data, ttl):
+        pass
+    
+    @abstractmethod
+    async def has_session(self, key):
+        pass
+    
+    @abstractmethod
+    async def pop_session(self, key):
+        """Remove and return a session; only one caller ever gets it"""
+    
+    @abstractmethod
+    async def get_link(self, key):
+        pass
+    
+    @abstractmethod
+    async def set_link(self, key, result, ttl):
+        pass
+    
+    @abstractmethod
+    async def link_ttl(self, key):
+        """Seconds left before a cached link expires, 0 if not cached"""
+    
+    @abstractmethod
+    async def save_user(self, user_id, record):
+        pass
+    
+    @abstractmethod
+    async def count_users(self):
+        pass
+    
+    @abstractmethod
+    async def count_sessions(self):
+        """Cheap count of live sessions, fine to call on every /info"""
+    
+    @abstractmethod
+    async def stats(self):
+        """Return {'sessions': n, 'cooldowns': n, 'links': n}"""
+    
+    async def close(self):
+        pass
+
+class TransferQueue(ABC):
+    """Queue of Telegram transfers shared by all workers (see transfer_consumer)"""
+    
+    @abstractmethod
+    async def push_transfer(self, job):
+        pass
+    
+    @abstractmethod
+    async def pop_transfer(self, timeout):
+        """Next job, or None after timeout seconds"""
+
+class MemoryBackend(StateBackend):
+    """Process-local state (single worker); users are persisted to SQLite"""
+    
+    async def acquire_cooldown(self, user_id, seconds):
+        if user_id in user_last:
+            return False
+        user_last.set(user_id, time.time(), ttl=seconds)
+        return True
+    
+    async def set_session(self, key, data, ttl):
+        sessions.set(key, data, ttl=ttl)
+    
+    async def has_session(self, key):
+        return key in sessions
+    
+    async def pop_session(self, key):
+        return sessions.pop(key)
+    
+    async def get_link(self, key):
+        return link_cache.get(key)
+    
+    async def set_link(self, key, result, ttl):
+        link_cache.set(key, result, ttl=ttl)
+    
+    async def link_ttl(self, key):
+        return link_cache.ttl_left(key)
+    
+    async def save_user(self, user_id, record):
+        user_data[user_id] = record
+        # Persisted by the next flush_user_data() batch
+        pending_users[user_id] = record
+    
+    async def count_users(self):
+        return len(user_data)
+    
+    async def count_sessions(self):
+        # May include a few expired entries until the next sweep_loop pass
+        return len(sessions)
+    
+    async def stats(self):
+        sessions.expire()
+        user_last.expire()
+        link_cache.expire()
+        return {'sessions': len(sessions), 'cooldowns': len(user_last), 'links': len(link_cache)}
+
+class RedisBackend(StateBackend, TransferQueue):
+    """State shared through a Redis-protocol server so several workers can run"""
+    
+    def __init__(self, url, prefix=REDIS_PREFIX, client=None):
+        if client is None:
+            import redis.asyncio as aioredis  # optional dependency, only needed with REDIS_URL
+            client = aioredis.from_url(url, decode_responses=True)
+        self.redis = client
+        self.prefix = prefix
+    
+    def _key(self, kind, key=""):
+        return f"{self.prefix}{kind}:{key}" if key != "" else f"{self.prefix}{kind}"
+    
+    async def acquire_cooldown(self, user_id, seconds):
+        # SET NX EX is atomic, so two workers can't both start a cooldown
+        return bool(await self.redis.set(self._key("cooldown", user_id), 1, nx=True, ex=seconds))
+    
+    async def set_session(self, key, data, ttl):
+        ttl_ms = max(1, int(ttl * 1000))
+        # The sessions index (a ZSET scored by expiry time) lets count_sessions avoid a SCAN
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(self._key("session", key), json.dumps(data), px=ttl_ms)
+            pipe.zadd(self._key("sessions"), {key: int(time.time() * 1000) + ttl_ms})
+            await pipe.execute()
+    
+    async def has_session(self, key):
+        return bool(await self.redis.exists(self._key("session", key)))
+    
+    async def pop_session(self, key):
+        # GET + DEL in one MULTI so only one worker can take the session
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.get(self._key("session", key))
+            pipe.delete(self._key("session", key))
+            pipe.zrem(self._key("sessions"), key)
+            data, _, _ = await pipe.execute()
+        return json.loads(data) if data else None
+    
+    async def get_link(self, key):
+        data = await self.redis.get(self._key("link", key))
+        return tuple(json.loads(data)) if data else None
+    
+    async def set_link(self, key, result, ttl):
+        await self.redis.set(self._key("link", key), json.dumps(result), ex=max(1, int(ttl)))
+    
+    async def link_ttl(self, key):
+        ms = await self.redis.pttl(self._key("link", key))
+        return ms / 1000 if ms > 0 else 0
+    
+    async def save_user(self, user_id, record):
+        await self.redis.hset(self._key("users"), user_id, json.dumps(record))
+    
+    async def count_users(self):
+        return await self.redis.hlen(self._key("users"))
+    
+    async def count_sessions(self):
+        # Trim index entries whose session already expired, then count the rest
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(self._key("sessions"), "-inf", int(time.time() * 1000))
+            pipe.zcard(self._key("sessions"))
+            _, count = await pipe.execute()
+        return count
+    
+    async def push_transfer(self, job):
+        await self.redis.rpush(self._key("transfers"), json.dumps(job))
+    
+    async def pop_transfer(self, timeout):
+        item = await self.redis.blpop([self._key("transfers")], timeout=timeout)
+        return json.loads(item[1]) if item else None
+    
+    async def _count(self, kind):
+        count = 0
+        async for _ in self.redis.scan_iter(match=self._key(kind, "*"), count=500):
+            count += 1
+        return count
+    
+    async def stats(self):
+        return {
+            'sessions': await self.count_sessions(),
+            'cooldowns': await self._count("cooldown"),
+            'links': await self._count("link"),
+            'transfers': await self.redis.llen(self._key("transfers")),
+        }
+    
+    async def close(self):
+        await self.redis.aclose()
+
+state = RedisBackend(REDIS_URL) if REDIS_URL else MemoryBackend()
+
+async def sweep_loop():
+    """Periodically drop expired sessions, cooldowns, cache entries and abandoned partials"""
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        for cache in (sessions, user_last, link_cache, subscription_cache):
+            cache.expire()
+        await asyncio.to_thread(cleanup_partials)
+
+# ---------- LINK EXTRACTION ----------
+TERABOX_DOMAINS = (
+    'terabox.com', 'terabox.app', 'teraboxapp.com', 'teraboxurl.com', '1024tera.com', '1024tera.co',
+    '1024terabox.com', '1024-terabox.com', 'mirrobox.com', 'nephobox.com', 'freeterabox.com', '4funbox.com',
+    '4funbox.co', 'momerybox.com', 'tibibox.com', 'terabox.fun', 'terabox.link', 'teraboxshare.com',
+    'teraboxsharefile.com', 'teraboxlink.com', 'terasharelink.com', 'terasharefile.com', 'terashareus.com',
+    'gibibox.com', 'pebibox.com', 'fancybox.in', 'bestclouddrive.com', '4funbox.in', 'teraboxfree.com',
+    'terabox.club', 'terabox.click',
+)
+
+TERABOX_DOMAIN_SET = frozenset(TERABOX_DOMAINS)
+
+# Any host name standing on its own, with an optional scheme and path. The
+# host is checked against TERABOX_DOMAIN_SET afterwards (see is_terabox_host),
+# so the cost per message doesn't grow with the domain list.
+HOST_LINK_RE = re.compile(
+    r"(?<![\w.@-])(?:https?://)?"
+    r"((?:[a-z0-9-]+\.)+[a-z0-9-]+)"
+    r"(?![\w.-])(?::\d+)?([/?#][^\s<>\"']*)?",
+    re.IGNORECASE
+)
+SHARE_PATH_RE = re.compile(r"/s/1?([\w-]+)")
+TRAILING_PUNCTUATION = ".,;:!?)]}>'\""
+
+def is_terabox_host(host):
+    """True if host is one of TERABOX_DOMAINS or a subdomain of one"""
+    labels = host.split(".")
+    return any(".".join(labels[i:]) in TERABOX_DOMAIN_SET for i in range(len(labels) - 1))
+
+def normalize_link(link):
+    """Return a stable cache key for a Terabox share link.
+    
+    /s/1<id> and ?surl=<id> links for the same share map to the same key.
+    """
+    link = link.strip()
+    parsed = urlparse(link if "://" in link else f"https://{link}")
+    surl = parse_qs(parsed.query).get("surl", [None])[0]
+    if not surl:
+        match = SHARE_PATH_RE.search(parsed.path)
+        surl = match.group(1) if match else None
+    if surl:
+        return f"terabox:{surl}"
+    host = parsed.netloc.lower().removeprefix("www.")
+    return f"{host}{parsed.path.rstrip('/')}"
+
+def extract_links(text):
+    """Return the Terabox share links in text, in order and without duplicates.
+    
+    Links get an https:// scheme if they had none. Bare hosts and Terabox
+    pages that don't name a share are skipped, so they never reach API_BASE.
+    """
+    links, seen = [], set()
+    text, pos = text or "", 0
+    while match := HOST_LINK_RE.search(text, pos):
+        host = match.group(1).lower()
+        if not is_terabox_host(host):
+            # A Terabox link may still follow inside what looked like this host's path
+            pos = match.end(1)
+            continue
+        pos = match.end()
+        path = (match.group(2) or "").rstrip(TRAILING_PUNCTUATION)
+        link = f"https://{host}{path}"
+        key = normalize_link(link)
+        if not key.startswith("terabox:") or key in seen:
+            continue
+        seen.add(key)
+        links.append(link)
+    return links
+
 # ---------- HELPER FUNCTIONS ----------
-def save_user_info(user_id, username, first_name, last_name, original_link, direct_link=None, title=None):
+async def save_user_info(user_id, username, first_name, last_name, original_link, direct_link=None, title=None):
     """Save user information when they send a link"""
-    user_data[str(user_id)] = {
+    record = {
         'username': username or 'No Username',
         'first_name': first_name or 'No First Name',
         'last_name': last_name or '',
@@ -58,50 +897,103 @@ def save_user_info(user_id, username, first_name, last_name, original_link, dire
         'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         'last_activity': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     }
-    # Save to file for persistence
-    try:
-        with open('user_data.json', 'w') as f:
-            json.dump(user_data, f, indent=2)
-    except Exception as e:
-        print(f"Error saving user data: {e}")
+    await state.save_user(str(user_id), record)
+
+def open_user_db():
+    db = sqlite3.connect(USER_DB_PATH, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    db.execute("CREATE TABLE IF NOT EXISTS videos (link_key TEXT PRIMARY KEY, data TEXT NOT NULL)")
+    db.commit()
+    return db
+
+def write_users(rows):
+    """Upsert {user_id: record} into the user store in one transaction"""
+    with user_db_lock, user_db:
+        user_db.executemany(
+            "INSERT OR REPLACE INTO users (user_id, data) VALUES (?, ?)",
+            [(uid, json.dumps(record)) for uid, record in rows.items()]
+        )
+
+def write_video_id(link_key, record):
+    with user_db_lock, user_db:
+        if record is None:
+            user_db.execute("DELETE FROM videos WHERE link_key = ?", (link_key,))
+        else:
+            user_db.execute(
+                "INSERT OR REPLACE INTO videos (link_key, data) VALUES (?, ?)",
+                (link_key, json.dumps(record))
+            )
 
 def load_user_data():
-    """Load user data from file"""
-    global user_data
+    """Load users and cached video file_ids, migrating user_data.json once"""
+    global user_data, user_db, video_ids
     try:
-        if os.path.exists('user_data.json'):
-            with open('user_data.json', 'r') as f:
-                user_data = json.load(f)
-                print(f"Loaded {len(user_data)} users from file")
+        user_db = open_user_db()
+        
+        if os.path.exists(USER_JSON_PATH):
+            with open(USER_JSON_PATH, 'r') as f:
+                legacy = json.load(f)
+            write_users(legacy)
+            os.replace(USER_JSON_PATH, USER_JSON_PATH + ".migrated")
+            print(f"Migrated {len(legacy)} users from {USER_JSON_PATH}")
+        
+        user_data = {uid: json.loads(data) for uid, data in user_db.execute("SELECT user_id, data FROM users")}
+        print(f"Loaded {len(user_data)} users from {USER_DB_PATH}")
+        
+        video_ids = {key: json.loads(data) for key, data in user_db.execute("SELECT link_key, data FROM videos")}
+        print(f"Loaded {len(video_ids)} cached video file_ids")
     except Exception as e:
         print(f"Error loading user data: {e}")
         user_data = {}
 
-async def check_subscription(user_id, context):
-    """Check if user is subscribed to channel and group"""
+async def flush_user_data():
+    """Commit pending user records in a worker thread"""
+    global pending_users
+    if not pending_users or user_db is None:
+        return
+    rows, pending_users = pending_users, {}
     try:
-        # Check channel subscription
-        try:
-            channel_member = await context.bot.get_chat_member(CHANNEL_USERNAME, user_id)
-            if channel_member.status in ['left', 'kicked']:
-                return False, "channel"
-        except Exception as e:
-            print(f"Channel check error: {e}")
-            return False, "channel"
-        
-        # Check group subscription
-        try:
-            group_member = await context.bot.get_chat_member(GROUP_USERNAME, user_id)
-            if group_member.status in ['left', 'kicked']:
-                return False, "group"
-        except Exception as e:
-            print(f"Group check error: {e}")
-            return False, "group"
-        
-        return True, "both"
+        await asyncio.to_thread(write_users, rows)
     except Exception as e:
-        print(f"Subscription check error: {e}")
-        return False, "channel"
+        print(f"Error saving user data: {e}")
+        # Keep the batch for the next flush unless newer records replaced it
+        pending_users = {**rows, **pending_users}
+
+async def user_flush_loop():
+    while True:
+        await asyncio.sleep(USER_FLUSH_INTERVAL)
+        await flush_user_data()
+
+async def check_subscription(user_id, context, refresh=False):
+    """Check if user is subscribed to channel and group.
+    
+    Results are cached per user; pass refresh=True to bypass the cache.
+    """
+    if not refresh:
+        cached = subscription_cache.get(user_id)
+        if cached is not None:
+            return cached
+    
+    channel_member, group_member = await asyncio.gather(
+        context.bot.get_chat_member(CHANNEL_USERNAME, user_id),
+        context.bot.get_chat_member(GROUP_USERNAME, user_id),
+        return_exceptions=True
+    )
+    
+    result = (True, "both")
+    for where, member in (("channel", channel_member), ("group", group_member)):
+        if isinstance(member, Exception):
+            print(f"{where.title()} check error: {member}")
+            result = (False, where)
+            break
+        if member.status in ['left', 'kicked']:
+            result = (False, where)
+            break
+    
+    subscription_cache.set(user_id, result, ttl=None if result[0] else SUB_NEGATIVE_TTL)
+    return result
 
 def allowed(update):
     """Check if message is from allowed group or private chat"""
@@ -133,6 +1025,11 @@ def format_time(seconds):
         minutes = int((seconds % 3600) // 60)
         return f"{hours}h {minutes}m"
 
+def format_speed(bytes_per_sec):
+    if bytes_per_sec > 1024 * 1024:
+        return f"{bytes_per_sec/(1024*1024):.1f} MB/s"
+    return f"{bytes_per_sec/1024:.1f} KB/s"
+
 def format_size(bytes_size):
     if bytes_size < 1024:
         return f"{bytes_size} B"
@@ -143,186 +1040,606 @@ def format_size(bytes_size):
     else:
         return f"{bytes_size/(1024*1024*1024):.1f} GB"
 
-# ---------- SEND LINKS TO SAVE GROUP ----------
-async def send_links_to_save_group(context, user_info, original_link, direct_link, title, size):
-    """Send BOTH original and direct links to save group"""
-    try:
-        print(f"\n📤 SENDING LINKS TO SAVE GROUP {SAVE_GROUP_ID}")
-        print(f"User: {user_info['first_name']} (ID: {user_info['user_id']})")
-        print(f"Original Link: {original_link}")
-        print(f"Direct Link: {direct_link}")
-        
-        # Format the main message
-        user_text = (
-            f"👤 **USER REQUEST**\n\n"
-            f"🆔 User ID: `{user_info['user_id']}`\n"
-            f"👤 Name: {user_info['first_name']} {user_info.get('last_name', '')}\n"
-            f"📛 Username: @{user_info.get('username', 'N/A')}\n"
-            f"📅 Time: {user_info['timestamp']}\n\n"
-            f"📁 **FILE DETAILS**\n"
-            f"📝 Title: {title}\n"
-            f"📦 Size: {size}\n\n"
-            f"🔗 **ORIGINAL LINK**\n{original_link}\n\n"
-            f"⬇️ **DIRECT DOWNLOAD LINK**\n{direct_link}\n\n"
-            f"#Terabox #{user_info['user_id']} #Links"
-        )
-        
-        # Send main message to save group
-        await context.bot.send_message(
-            chat_id=SAVE_GROUP_ID,
-            text=user_text,
-            parse_mode=ParseMode.MARKDOWN,
-            disable_web_page_preview=False
-        )
-        print(f"✅ Main info sent to save group")
+# ---------- SAVE GROUP QUEUE ----------
+class SaveGroupQueue:
+    """Background sender for SAVE_GROUP_ID messages.
+    
+    Jobs are (bot method name, kwargs) pairs so they can spill to disk
+    when the in-memory backlog is full and be replayed later.
+    """
+    
+    def __init__(self, maxsize, rate, burst, spill_path):
+        self.queue = asyncio.Queue(maxsize)
+        self.bucket = TokenBucket(rate, burst)
+        self.spill_path = spill_path
+        self.sent = 0
+        self.failed = 0
+        self.spilled = 0
+        self.dropped = 0
+    
+    def put(self, method, **kwargs):
+        job = {'method': method, 'kwargs': kwargs}
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            self._spill([job])
+    
+    def _spill(self, jobs):
+        try:
+            with open(self.spill_path, 'a') as f:
+                for job in jobs:
+                    f.write(json.dumps(job) + "\n")
+            self.spilled += len(jobs)
+        except Exception as e:
+            print(f"❌ Save group backlog full, dropping {len(jobs)} message(s): {e}")
+            self.dropped += len(jobs)
+    
+    def _replay_spill(self):
+        draining = self.spill_path + ".draining"
+        try:
+            os.replace(self.spill_path, draining)
+            with open(draining) as f:
+                jobs = [json.loads(line) for line in f if line.strip()]
+            os.remove(draining)
+        except Exception as e:
+            print(f"❌ Failed to replay save group backlog: {e}")
+            return
+        print(f"📮 Replaying {len(jobs)} spilled save group message(s)")
+        for i, job in enumerate(jobs):
+            try:
+                self.queue.put_nowait(job)
+            except asyncio.QueueFull:
+                self._spill(jobs[i:])
+                break
+    
+    def spill_pending(self):
+        """Move queued jobs to disk (used on shutdown)"""
+        jobs = []
+        while not self.queue.empty():
+            jobs.append(self.queue.get_nowait())
+        if jobs:
+            self._spill(jobs)
+    
+    async def run(self, bot):
+        while True:
+            if self.queue.empty() and os.path.exists(self.spill_path):
+                self._replay_spill()
+            job = await self.queue.get()
+            await self._send(bot, job)
+    
+    async def _send(self, bot, job):
+        method = getattr(bot, job['method'])
+        kwargs = dict(job['kwargs'])
+        if job['method'] == 'send_document':
+            kwargs['document'] = kwargs['document'].encode()
+        attempts = 0
         
-        # Send separate messages for easy copying
-        await asyncio.sleep(1)
+        while attempts < SAVE_SEND_ATTEMPTS:
+            await self.bucket.acquire()
+            try:
+                await method(chat_id=SAVE_GROUP_ID, **kwargs)
+                self.sent += 1
+                return
+            except RetryAfter as e:
+                # Flood waits don't count as failed attempts
+                print(f"⏳ Save group flood wait: {e.retry_after}s")
+                self.bucket.pause(e.retry_after)
+                retries.inc(operation="save_group_flood_wait")
+            except BadRequest as e:
+                # Usually broken markdown in user-supplied titles; resend as plain text
+                if kwargs.pop('parse_mode', None) is None:
+                    print(f"❌ Save group rejected message: {e}")
+                    break
+            except NetworkError as e:
+                attempts += 1
+                retries.inc(operation="save_group")
+                print(f"❌ Save group send error (attempt {attempts}/{SAVE_SEND_ATTEMPTS}): {e}")
+            except Exception as e:
+                print(f"❌ Save group send error: {e}")
+                break
         
-        # Send original link separately
-        await context.bot.send_message(
-            chat_id=SAVE_GROUP_ID,
-            text=f"🔗 **Original Terabox Link:**\n{original_link}\n\n#OriginalLink",
-            disable_web_page_preview=False
+        self.failed += 1
+
+save_queue = SaveGroupQueue(SAVE_QUEUE_SIZE, SAVE_RATE, SAVE_BURST, SAVE_SPILL_PATH)
+
+class SaveGroupDigest:
+    """Batches save group entries over a time window or up to max_entries"""
+    
+    def __init__(self, window, max_entries, inline_limit):
+        self.window = window
+        self.max_entries = max_entries
+        self.inline_limit = inline_limit
+        self.entries = []
+        self.first_at = 0
+    
+    def add(self, entry):
+        if not self.entries:
+            self.first_at = time.monotonic()
+        self.entries.append(entry)
+        if len(self.entries) >= self.max_entries:
+            self.flush()
+    
+    def flush(self):
+        if not self.entries:
+            return
+        batch, self.entries = self.entries, []
+        queue_save_entries(batch, "📋 SAVE DIGEST", "#Digest #Links", "digest", self.inline_limit)
+    
+    async def run(self):
+        while True:
+            await asyncio.sleep(1)
+            if self.entries and time.monotonic() - self.first_at >= self.window:
+                self.flush()
+
+save_digest = SaveGroupDigest(SAVE_DIGEST_WINDOW, SAVE_DIGEST_MAX, SAVE_DIGEST_INLINE)
+
+def queue_save_entries(entries, heading, tags, file_prefix, inline_limit):
+    """Queue entries as one save group message, or as one JSONL document if they don't fit"""
+    lines = [f"{heading} ({len(entries)} entries)\n"]
+    for i, e in enumerate(entries, 1):
+        lines.append(
+            f"{i}. {'🎬' if e['kind'] == 'video' else '👤'} {e['name']} (@{e['username']}, {e['user_id']}) • {e['time']}\n"
+            f"📝 {e['title']} • 📦 {e['size']}\n"
+            f"🔗 {e['original_link']}\n"
+            f"⬇️ {e['direct_link']}\n"
         )
-        print(f"✅ Original link sent separately")
-        
-        await asyncio.sleep(1)
-        
-        # Send direct link separately
-        await context.bot.send_message(
-            chat_id=SAVE_GROUP_ID,
-            text=f"⬇️ **Direct Download Link:**\n{direct_link}\n\n#DirectLink",
-            disable_web_page_preview=False
+    text = "\n".join(lines) + f"\n{tags}"
+    
+    if len(entries) <= inline_limit and len(text) <= 4096:
+        save_queue.put('send_message', text=text, disable_web_page_preview=True)
+    else:
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        save_queue.put(
+            'send_document',
+            document="".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries),
+            filename=f"{file_prefix}-{stamp}.jsonl",
+            caption=f"{heading}: {len(entries)} entries\n\n{tags}"
         )
-        print(f"✅ Direct link sent separately")
-        
-        print(f"✅ ALL LINKS SUCCESSFULLY SENT TO SAVE GROUP")
-        
-    except Exception as e:
-        print(f"❌ Error sending to save group: {e}")
-        # Try a simpler message
-        try:
-            simple_msg = f"User: {user_info['first_name']} (ID: {user_info['user_id']})\nOriginal: {original_link}\nDirect: {direct_link}"
-            await context.bot.send_message(
-                chat_id=SAVE_GROUP_ID,
-                text=simple_msg
-            )
-        except:
-            print(f"❌ Failed to send even simple message")
+
+def digest_entry(kind, user_info, original_link, direct_link, title, size):
+    return {
+        'kind': kind,
+        'user_id': user_info['user_id'],
+        'name': f"{user_info['first_name']} {user_info.get('last_name', '')}".strip(),
+        'username': user_info.get('username', 'N/A'),
+        'time': user_info.get('timestamp') or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'title': title,
+        'size': size,
+        'original_link': original_link,
+        'direct_link': direct_link,
+    }
+
+# ---------- SEND LINKS TO SAVE GROUP ----------
+async def send_links_to_save_group(context, user_info, original_link, direct_link, title, size):
+    """Queue BOTH original and direct links for the save group"""
+    print(f"\n📤 QUEUEING LINKS FOR SAVE GROUP {SAVE_GROUP_ID}")
+    print(f"User: {user_info['first_name']} (ID: {user_info['user_id']})")
+    print(f"Original Link: {original_link}")
+    print(f"Direct Link: {direct_link}")
+    
+    if SAVE_DIGEST:
+        save_digest.add(digest_entry('link', user_info, original_link, direct_link, title, size))
+        return
+    
+    # Format the main message
+    user_text = (
+        f"👤 **USER REQUEST**\n\n"
+        f"🆔 User ID: `{user_info['user_id']}`\n"
+        f"👤 Name: {user_info['first_name']} {user_info.get('last_name', '')}\n"
+        f"📛 Username: @{user_info.get('username', 'N/A')}\n"
+        f"📅 Time: {user_info['timestamp']}\n\n"
+        f"📁 **FILE DETAILS**\n"
+        f"📝 Title: {title}\n"
+        f"📦 Size: {size}\n\n"
+        f"🔗 **ORIGINAL LINK**\n{original_link}\n\n"
+        f"⬇️ **DIRECT DOWNLOAD LINK**\n{direct_link}\n\n"
+        f"#Terabox #{user_info['user_id']} #Links"
+    )
+    
+    save_queue.put(
+        'send_message',
+        text=user_text,
+        parse_mode=ParseMode.MARKDOWN,
+        disable_web_page_preview=False
+    )
+    
+    # Separate messages for easy copying
+    save_queue.put(
+        'send_message',
+        text=f"🔗 **Original Terabox Link:**\n{original_link}\n\n#OriginalLink",
+        disable_web_page_preview=False
+    )
+    save_queue.put(
+        'send_message',
+        text=f"⬇️ **Direct Download Link:**\n{direct_link}\n\n#DirectLink",
+        disable_web_page_preview=False
+    )
+
+async def send_batch_to_save_group(context, user_info, resolved):
+    """Queue a whole batch as one save group entry; resolved is [(original, direct, title, size)]"""
+    print(f"\n📤 QUEUEING BATCH OF {len(resolved)} LINKS FOR SAVE GROUP {SAVE_GROUP_ID}")
+    print(f"User: {user_info['first_name']} (ID: {user_info['user_id']})")
+    
+    entries = [digest_entry('link', user_info, *item) for item in resolved]
+    if SAVE_DIGEST:
+        for entry in entries:
+            save_digest.add(entry)
+        return
+    queue_save_entries(entries, "📦 BATCH REQUEST", f"#Batch #{user_info['user_id']} #Links", "batch", len(entries))
 
 # ---------- FORWARD VIDEO TO SAVE GROUP ----------
 async def forward_video_to_save_group(context, video_message, user_info, title, size, direct_link, original_link):
-    """Forward video and ALL links to save group"""
-    try:
-        print(f"\n🎬 FORWARDING VIDEO TO SAVE GROUP {SAVE_GROUP_ID}")
+    """Queue the video and ALL links for the save group"""
+    print(f"\n🎬 QUEUEING VIDEO FOR SAVE GROUP {SAVE_GROUP_ID}")
+    
+    save_queue.put(
+        'forward_message',
+        from_chat_id=video_message.chat.id,
+        message_id=video_message.message_id
+    )
+    
+    if SAVE_DIGEST:
+        save_digest.add(digest_entry('video', user_info, original_link, direct_link, title, size))
+        return True
+    
+    # Video info with BOTH links
+    video_info = (
+        f"🎬 **VIDEO DOWNLOADED TO TELEGRAM**\n\n"
+        f"📁 Title: {title}\n"
+        f"📦 Size: {size}\n\n"
+        f"👤 **USER INFO**\n"
+        f"🆔 ID: `{user_info['user_id']}`\n"
+        f"👤 Name: {user_info['first_name']}\n"
+        f"📛 Username: @{user_info.get('username', 'N/A')}\n\n"
+        f"🔗 **ORIGINAL TERABOX LINK**\n{original_link}\n\n"
+        f"⬇️ **DIRECT DOWNLOAD LINK**\n{direct_link}\n\n"
+        f"#VideoDownload #{user_info['user_id']}"
+    )
+    
+    save_queue.put(
+        'send_message',
+        text=video_info,
+        parse_mode=ParseMode.MARKDOWN,
+        disable_web_page_preview=True
+    )
+    
+    # Links separately for easy access
+    save_queue.put(
+        'send_message',
+        text=f"🔗 Original: {original_link}\n\n#LinkCopy",
+        disable_web_page_preview=False
+    )
+    save_queue.put(
+        'send_message',
+        text=f"⬇️ Direct: {direct_link}\n\n#DirectDownload",
+        disable_web_page_preview=False
+    )
+    return True
+
+# ---------- SHARED HTTP CLIENT ----------
+def http_trace_config():
+    """Count requests, connection reuse and DNS cache hits for /stats"""
+    def counter(name):
+        async def on_event(session, ctx, params):
+            http_stats[name] += 1
+        return on_event
+    
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(counter('requests'))
+    trace.on_connection_create_end.append(counter('new_connections'))
+    trace.on_connection_reuseconn.append(counter('reused_connections'))
+    trace.on_dns_cache_hit.append(counter('dns_hits'))
+    trace.on_dns_cache_miss.append(counter('dns_misses'))
+    return trace
+
+async def open_http_session():
+    """Create the application-wide keep-alive connection pool"""
+    global http_session
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_SIZE,
+        limit_per_host=max(HTTP_POOL_PER_HOST, MAX_TRANSFERS * DOWNLOAD_SEGMENTS + 4),
+        ttl_dns_cache=HTTP_DNS_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE
+    )
+    # No total timeout by default: downloads can take a long time, stalls can't
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=15, sock_read=60)
+    http_session = aiohttp.ClientSession(connector=connector, timeout=timeout, trace_configs=[http_trace_config()])
+    return http_session
+
+async def get_http_session():
+    """Return the shared aiohttp session, opening it if needed"""
+    if http_session is None or http_session.closed:
+        return await open_http_session()
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+def http_pool_stats():
+    """Return (connections in use, idle keep-alive connections)"""
+    if http_session is None or http_session.closed:
+        return 0, 0
+    connector = http_session.connector
+    in_use = len(getattr(connector, '_acquired', ()))
+    idle = sum(len(conns) for conns in getattr(connector, '_conns', {}).values())
+    return in_use, idle
+
+# ---------- IMPROVED TERABOX API WITH RETRY ----------
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/121.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15',
+]
+
+class ResolverEndpoint:
+    """One API_BASE-compatible resolver with a latency window and a circuit breaker.
+    
+    The circuit opens after BREAKER_FAILURES consecutive failures and fails
+    fast for BREAKER_COOLDOWN seconds; then one half-open probe decides
+    whether it closes again.
+    """
+    
+    def __init__(self, url):
+        self.url = url
+        self.name = urlparse(url).netloc or url
+        self.latencies = deque(maxlen=200)
+        self.health = 1.0  # moving average of successes
+        self.consecutive_failures = 0
+        self.state = "closed"
+        self.opened_at = 0
+        self.probing = False
+    
+    def available(self, now):
+        if self.state == "closed":
+            return True
+        return not self.probing and now - self.opened_at >= BREAKER_COOLDOWN
+    
+    def acquire(self):
+        """Mark the endpoint as used; an expired open circuit becomes a half-open probe"""
+        if self.state != "closed":
+            self.state = "half_open"
+            self.probing = True
+    
+    def record(self, ok, latency=None):
+        self.probing = False
+        self.health = self.health * 0.9 + (0.1 if ok else 0)
+        if ok:
+            self.latencies.append(latency)
+            self.consecutive_failures = 0
+            if self.state != "closed":
+                print(f"✅ Resolver {self.name} recovered")
+            self.state = "closed"
+            return
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= BREAKER_FAILURES:
+            if self.state == "closed":
+                print(f"🔴 Resolver {self.name} circuit open after {self.consecutive_failures} failures")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+    
+    def record_lost_race(self, elapsed):
+        """Another endpoint answered first; count the time this one had taken.
         
-        # First forward the video
-        forwarded_msg = await context.bot.forward_message(
-            chat_id=SAVE_GROUP_ID,
-            from_chat_id=video_message.chat.id,
-            message_id=video_message.message_id
-        )
-        print(f"✅ Video forwarded to save group")
+        The sample is a lower bound on its latency, so an endpoint that keeps
+        losing slides down the ranking and gets a later hedge delay.
+        """
+        self.latencies.append(elapsed)
+        self.health *= 0.9
+    
+    def percentile(self, pct):
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+    
+    def hedge_delay(self):
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, self.percentile(0.95))
+    
+    def describe(self):
+        icon = {"closed": "✅", "half_open": "🟡", "open": "🔴"}[self.state]
+        p95 = format_time(self.percentile(0.95)) if self.latencies else "n/a"
+        return f"{icon} {self.name} ({self.health:.0%}, p95 {p95})"
+
+# A resolver answered, but the share has no downloadable link
+NO_LINK = (None, None, None)
+
+class ResolverPool:
+    """Sends each resolve attempt to the healthiest endpoint and hedges slow ones.
+    
+    If the first endpoint hasn't answered within its p95 latency, the next
+    one is asked as well and the first usable answer wins. A failed request
+    moves on to the next endpoint right away.
+    """
+    
+    def __init__(self, urls):
+        self.endpoints = [ResolverEndpoint(url) for url in urls]
+    
+    def ranked(self):
+        now = time.monotonic()
+        ready = [endpoint for endpoint in self.endpoints if endpoint.available(now)]
+        # Endpoints with no latency samples yet go after ones that have answered
+        return sorted(ready, key=lambda e: (e.state != "closed", not e.latencies, -e.health, e.percentile(0.5) if e.latencies else 0))
+    
+    async def _query(self, endpoint, link):
+        """Ask one endpoint; returns (download, title, size), NO_LINK if it
+        answered without a link, or None if the request itself failed"""
+        session = await get_http_session()
+        timeout = aiohttp.ClientTimeout(total=RESOLVE_TIMEOUT)
+        headers = {
+            'User-Agent': random.choice(USER_AGENTS),
+            'Accept': 'application/json',
+            'Accept-Language': 'en-US,en;q=0.9',
+        }
+        params = {'key': 'RushVx', 'link': link}
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            async with session.get(endpoint.url, params=params, headers=headers, timeout=timeout) as r:
+                outcome = f"http_{r.status}"
+                if r.status == 200:
+                    data = await r.json(content_type=None)
+                    outcome = "empty"
+                    
+                    if "data" in data and len(data["data"]) > 0:
+                        d = data["data"][0]
+                        dl = d.get("download")
+                        
+                        if dl and dl.startswith("http"):
+                            outcome = "ok"
+                            return dl, d.get("title", "Video"), d.get("size", "Unknown")
+                    return NO_LINK
+        except asyncio.CancelledError:
+            # Lost the race to a hedged request; says nothing about this endpoint
+            outcome = "cancelled"
+            endpoint.probing = False
+            raise
+        except Exception as e:
+            print(f"❌ Resolver {endpoint.name}: {str(e) or type(e).__name__}")
+        finally:
+            latency = time.monotonic() - started
+            resolver_request_seconds.observe(latency, endpoint=endpoint.name, outcome=outcome)
+            if outcome != "cancelled":
+                # An answer without a link is still a healthy endpoint
+                endpoint.record(outcome in ("ok", "empty"), latency)
+        return None
+    
+    async def resolve(self, link):
+        """One hedged attempt across the endpoints.
         
-        # Send video info with BOTH links
-        video_info = (
-            f"🎬 **VIDEO DOWNLOADED TO TELEGRAM**\n\n"
-            f"📁 Title: {title}\n"
-            f"📦 Size: {size}\n\n"
-            f"👤 **USER INFO**\n"
-            f"🆔 ID: `{user_info['user_id']}`\n"
-            f"👤 Name: {user_info['first_name']}\n"
-            f"📛 Username: @{user_info.get('username', 'N/A')}\n\n"
-            f"🔗 **ORIGINAL TERABOX LINK**\n{original_link}\n\n"
-            f"⬇️ **DIRECT DOWNLOAD LINK**\n{direct_link}\n\n"
-            f"#VideoDownload #{user_info['user_id']}"
-        )
+        Returns the first link found, NO_LINK if an endpoint answered without
+        one, or None if no endpoint gave an answer at all.
+        """
+        candidates = self.ranked()
+        tasks = {}  # task -> (endpoint, started)
+        answered = False
         
-        await context.bot.send_message(
-            chat_id=SAVE_GROUP_ID,
-            text=video_info,
-            parse_mode=ParseMode.MARKDOWN,
-            disable_web_page_preview=True
-        )
+        def launch(hedge=False):
+            endpoint = candidates.pop(0)
+            endpoint.acquire()
+            if hedge:
+                resolver_hedges.inc(endpoint=endpoint.name)
+                print(f"🔀 Hedging resolve to {endpoint.name}")
+            tasks[asyncio.create_task(self._query(endpoint, link))] = (endpoint, time.monotonic())
+            return endpoint.hedge_delay()
         
-        # Send links separately for easy access
-        await asyncio.sleep(1)
-        await context.bot.send_message(
-            chat_id=SAVE_GROUP_ID,
-            text=f"🔗 Original: {original_link}\n\n#LinkCopy",
-            disable_web_page_preview=False
-        )
+        if not candidates:
+            return None
+        delay = launch()
+        try:
+            while tasks:
+                done, _ = await asyncio.wait(tasks, timeout=delay if candidates else None, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    delay = launch(hedge=True)
+                    continue
+                for task in done:
+                    tasks.pop(task)
+                    if task.result() is NO_LINK:
+                        answered = True
+                    elif task.result() is not None:
+                        now = time.monotonic()
+                        for endpoint, launched in tasks.values():
+                            endpoint.record_lost_race(now - launched)
+                        return task.result()
+                if candidates and not tasks:
+                    delay = launch()
+            return NO_LINK if answered else None
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    def all_open(self):
+        return not self.ranked()
+
+resolver_pool = ResolverPool(RESOLVER_ENDPOINTS)
+
+async def terabox_with_retry(link, max_retries=RESOLVE_RETRIES, on_attempt=None):
+    """Resolve a share link via the resolver endpoints without blocking the event loop.
+
+    Returns (download, title, size), NO_LINK if a resolver answered that
+    the share has no link, or None if no resolver answered at all (errors,
+    timeouts, or every endpoint's circuit open, which fails straight away).
+    on_attempt(attempt, total) is awaited before every attempt.
+    """
+    answered = False
+    for attempt in range(1, max_retries + 1):
+        if resolver_pool.all_open():
+            resolver_fast_fails.inc()
+            print("🔴 All resolver circuits open, failing fast")
+            break
         
-        await asyncio.sleep(1)
-        await context.bot.send_message(
-            chat_id=SAVE_GROUP_ID,
-            text=f"⬇️ Direct: {direct_link}\n\n#DirectDownload",
-            disable_web_page_preview=False
-        )
+        print(f"Attempt {attempt}/{max_retries} for link: {link}")
         
-        print(f"✅ Video and ALL links forwarded to save group")
-        return True
+        if on_attempt:
+            await on_attempt(attempt, max_retries)
         
-    except Exception as e:
-        print(f"❌ Failed to forward video to save group: {e}")
-        return False
-
-# ---------- IMPROVED TERABOX API WITH RETRY ----------
-def terabox_with_retry(link, max_retries=5):
-    retries = 0
+        result = await resolver_pool.resolve(link)
+        if result is NO_LINK:
+            answered = True
+        elif result is not None:
+            print(f"✅ Link found on attempt {attempt}")
+            return result
+        
+        if attempt < max_retries:
+            retries.inc(operation="resolve")
+            wait_time = random.uniform(1, 3)
+            print(f"🔄 Retrying in {wait_time:.1f} seconds...")
+            await asyncio.sleep(wait_time)
     
-    while retries < max_retries:
-        retries += 1
-        print(f"Attempt {retries}/{max_retries} for link: {link}")
+    print(f"❌ Resolve failed for link: {link}")
+    return NO_LINK if answered else None
+
+async def _resolve_and_cache(link, key, on_attempt):
+    started = time.monotonic()
+    result = await terabox_with_retry(link, on_attempt=on_attempt)
+    if result is None:
+        # Resolvers down or failing fast: nothing is known about the link, so
+        # don't cache anything and let the next request try again
+        resolve_seconds.observe(time.monotonic() - started, outcome="failed")
+        return NO_LINK
+    resolve_seconds.observe(time.monotonic() - started, outcome="ok" if result[0] else "no_link")
+    # Links the resolvers say have nothing are cached briefly so repeats don't hammer them
+    await state.set_link(key, result, LINK_CACHE_TTL if result[0] else LINK_NEGATIVE_TTL)
+    return result
+
+async def resolve_link(link, on_attempt=None):
+    """Resolve a share link, serving repeats from the state backend's link cache.
+    
+    Concurrent calls for the same link share one in-flight resolution;
+    only the first caller receives on_attempt updates.
+    """
+    key = normalize_link(link)
+    cached = await state.get_link(key)
+    if cached is not None:
+        link_stats['hits'] += 1
+        print(f"⚡ Link cache hit: {key}")
+        return cached
+    link_stats['misses'] += 1
+    
+    task = inflight_resolves.get(key)
+    if task is None:
+        task = asyncio.create_task(_resolve_and_cache(link, key, on_attempt))
+        inflight_resolves[key] = task
         
-        try:
-            if retries > 1:
-                wait_time = random.uniform(1, 3)
-                time.sleep(wait_time)
-            
-            user_agents = [
-                'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-                'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/121.0',
-                'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15',
-            ]
-            
-            headers = {
-                'User-Agent': random.choice(user_agents),
-                'Accept': 'application/json',
-                'Accept-Language': 'en-US,en;q=0.9',
-            }
-            
-            params = {'key': 'RushVx', 'link': link}
-            r = requests.get(API_BASE, params=params, headers=headers, timeout=15)
-            
-            if r.status_code == 200:
-                data = r.json()
-                
-                if "data" in data and len(data["data"]) > 0:
-                    d = data["data"][0]
-                    dl = d.get("download")
-                    
-                    if dl and dl.startswith("http"):
-                        print(f"✅ Link found on attempt {retries}")
-                        return dl, d.get("title", "Video"), d.get("size", "Unknown")
-                        
-        except Exception as e:
-            print(f"❌ Error on attempt {retries}: {str(e)}")
+        def _forget(t):
+            if inflight_resolves.get(key) is t:
+                del inflight_resolves[key]
         
-        if retries < max_retries:
-            print(f"🔄 Retrying in 2 seconds...")
-            time.sleep(2)
+        task.add_done_callback(_forget)
+    else:
+        print(f"🔗 Joining in-flight resolution: {key}")
     
-    print(f"❌ All {max_retries} attempts failed")
-    return None, None, None
+    # Shield so one waiter giving up doesn't cancel the lookup for the rest
+    return await asyncio.shield(task)
 
 # ---------- SUBSCRIPTION CHECK WITH BUTTONS ----------
-async def check_and_require_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id=None):
+async def check_and_require_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id=None, refresh=False):
     if user_id is None:
         user_id = update.effective_user.id
     
-    subscribed, where = await check_subscription(user_id, context)
+    subscribed, where = await check_subscription(user_id, context, refresh=refresh)
     
     if not subscribed:
         buttons = []
@@ -362,15 +1679,13 @@ async def process_terabox_link(update: Update, context: ContextTypes.DEFAULT_TYP
     user = update.effective_user
     chat_id = update.message.chat.id
     
-    # Cooldown check
+    # Cooldown check (entries expire after COOLDOWN seconds)
     uid = user.id
-    now = time.time()
-    if uid in user_last and now - user_last[uid] < COOLDOWN:
-        await update.message.reply_text("⏳ Please wait 30 seconds before next request")
+    if not await state.acquire_cooldown(uid, COOLDOWN):
+        await update.message.reply_text(f"⏳ Please wait {COOLDOWN} seconds before next request")
         return
-    user_last[uid] = now
     
-    msg = await update.message.reply_text("🔍 Processing link (Attempt 1/5)...")
+    msg = await update.message.reply_text(f"🔍 Processing link (Attempt 1/{RESOLVE_RETRIES})...")
     
     async def update_progress_message(attempt, total):
         if attempt == 1:
@@ -380,25 +1695,13 @@ async def process_terabox_link(update: Update, context: ContextTypes.DEFAULT_TYP
         else:
             text = f"⏳ Last attempt... (Attempt {attempt}/{total})"
         
-        try:
-            await msg.edit_text(text)
-        except:
-            pass
+        progress_renderer.update(msg, text)
     
-    max_retries = 5
-    direct_link, title, size = None, None, None
-    
-    for attempt in range(1, max_retries + 1):
-        await update_progress_message(attempt, max_retries)
-        direct_link, title, size = terabox_with_retry(original_link, max_retries=1)
-        if direct_link:
-            break
-        if attempt < max_retries:
-            await asyncio.sleep(2)
+    direct_link, title, size = await resolve_link(original_link, on_attempt=update_progress_message)
     
     if not direct_link:
-        await msg.edit_text(
-            "❌ Download link not found after 5 attempts\n\n"
+        await progress_renderer.finish(msg, 
+            f"❌ Download link not found after {RESOLVE_RETRIES} attempts\n\n"
             "🔍 **Troubleshooting:**\n"
             "1. Check your link\n"
             "2. Try after some time\n"
@@ -416,38 +1719,123 @@ async def process_terabox_link(update: Update, context: ContextTypes.DEFAULT_TYP
         'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     }
     
-    # Save user data locally with ALL info
-    save_user_info(user.id, user.username, user.first_name, user.last_name, 
-                   original_link, direct_link, title)
+    # Save user data locally with ALL info
+    await save_user_info(user.id, user.username, user.first_name, user.last_name, 
+                         original_link, direct_link, title)
+    
+    # Store session until the direct link itself expires
+    await state.set_session(uid, {
+        'url': direct_link,
+        'title': title,
+        'size': size,
+        'user_info': user_info,
+        'original_link': original_link
+    }, ttl=await state.link_ttl(normalize_link(original_link)) or LINK_CACHE_TTL)
+    
+    # ✅ QUEUE BOTH LINKS FOR SAVE GROUP (sent in the background)
+    try:
+        await send_links_to_save_group(context, user_info, original_link, direct_link, title, size)
+    except Exception as e:
+        print(f"❌ Failed to queue links for save group: {e}")
+    
+    # Create buttons
+    buttons = [
+        [InlineKeyboardButton("📥 DIRECT DOWNLOAD", url=direct_link)],
+        [InlineKeyboardButton("📲 TELEGRAM DOWNLOAD", callback_data=f"tg_{uid}")]
+    ]
+    
+    await progress_renderer.finish(
+        msg,
+        f"✅ **Download Ready!**\n\n"
+        f"📁 Title: {title}\n"
+        f"📦 Size: {size}\n\n"
+        f"📌 **Choose download method:**\n\n"
+        f"{CREDIT}",
+        reply_markup=InlineKeyboardMarkup(buttons)
+    )
+
+# ---------- PROCESS SEVERAL LINKS (BATCH) ----------
+async def process_terabox_batch(update: Update, context: ContextTypes.DEFAULT_TYPE, links):
+    """Resolve several links concurrently and answer with one message.
+    
+    The batch costs one cooldown and one save group entry. Each file gets
+    its own session (f"{uid}:{i}") and tg_{uid}_{i} button.
+    """
+    user = update.effective_user
+    uid = user.id
+    
+    if not await state.acquire_cooldown(uid, COOLDOWN):
+        await update.message.reply_text(f"⏳ Please wait {COOLDOWN} seconds before next request")
+        return
+    
+    skipped = max(0, len(links) - BATCH_MAX_LINKS)
+    links = links[:BATCH_MAX_LINKS]
+    msg = await update.message.reply_text(f"🔍 Processing {len(links)} links...")
+    
+    limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+    done = 0
+    
+    async def resolve_one(link):
+        nonlocal done
+        async with limit:
+            result = await resolve_link(link)
+        done += 1
+        progress_renderer.update(msg, f"🔍 Processing links: {done}/{len(links)} {progress_bar(done * 100 / len(links))}")
+        return result
+    
+    results = await asyncio.gather(*(resolve_one(link) for link in links))
+    
+    user_info = {
+        'user_id': user.id,
+        'username': user.username or 'N/A',
+        'first_name': user.first_name,
+        'last_name': user.last_name or '',
+        'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+    
+    lines, buttons, failed, resolved = [], [], [], []
+    for i, (link, (direct_link, title, size)) in enumerate(zip(links, results), 1):
+        if not direct_link:
+            failed.append(str(i))
+            continue
+        resolved.append((link, direct_link, title, size))
+        await state.set_session(f"{uid}:{i}", {
+            'url': direct_link,
+            'title': title,
+            'size': size,
+            'user_info': user_info,
+            'original_link': link
+        }, ttl=await state.link_ttl(normalize_link(link)) or LINK_CACHE_TTL)
+        lines.append(f"{i}. 📁 {title[:40]} • 📦 {size}")
+        buttons.append([
+            InlineKeyboardButton(f"📥 {i}. DIRECT", url=direct_link),
+            InlineKeyboardButton(f"📲 {i}. TELEGRAM", callback_data=f"tg_{uid}_{i}")
+        ])
+    
+    if not resolved:
+        await progress_renderer.finish(msg,
+            f"❌ No download links found for {len(links)} links\n\n"
+            "🔄 Try again after 1-2 minutes"
+        )
+        return
     
-    # Store session
-    sessions[uid] = {
-        'url': direct_link,
-        'title': title,
-        'size': size,
-        'user_info': user_info,
-        'original_link': original_link
-    }
+    # Save user data locally (last resolved link)
+    await save_user_info(user.id, user.username, user.first_name, user.last_name, *resolved[-1][:3])
     
-    # ✅ SEND BOTH LINKS TO SAVE GROUP IMMEDIATELY
     try:
-        await send_links_to_save_group(context, user_info, original_link, direct_link, title, size)
-        print(f"✅ BOTH LINKS sent to save group for user {user.id}")
+        await send_batch_to_save_group(context, user_info, resolved)
     except Exception as e:
-        print(f"❌ Failed to send links to save group: {e}")
+        print(f"❌ Failed to queue batch for save group: {e}")
     
-    # Create buttons
-    buttons = [
-        [InlineKeyboardButton("📥 DIRECT DOWNLOAD", url=direct_link)],
-        [InlineKeyboardButton("📲 TELEGRAM DOWNLOAD", callback_data=f"tg_{uid}")]
-    ]
+    text = f"✅ **Batch Ready! ({len(resolved)}/{len(links)})**\n\n" + "\n".join(lines)
+    if failed:
+        text += f"\n\n❌ Not found: {', '.join(failed)}"
+    if skipped:
+        text += f"\n⚠️ {skipped} links skipped (max {BATCH_MAX_LINKS} per batch)"
     
-    await msg.edit_text(
-        f"✅ **Download Ready!**\n\n"
-        f"📁 Title: {title}\n"
-        f"📦 Size: {size}\n\n"
-        f"📌 **Choose download method:**\n\n"
-        f"{CREDIT}",
+    await progress_renderer.finish(
+        msg,
+        f"{text}\n\n📌 **Choose download method:**",
         reply_markup=InlineKeyboardMarkup(buttons)
     )
 
@@ -476,7 +1864,7 @@ def get_status_emoji(percent):
     else:
         return "✅"
 
-def create_download_stats(total, downloaded, elapsed):
+def create_download_stats(total, downloaded, elapsed, label="DOWNLOAD"):
     percent = (downloaded / total * 100) if total > 0 else 0
     
     speed_bps = downloaded / elapsed if elapsed > 0 else 0
@@ -499,7 +1887,7 @@ def create_download_stats(total, downloaded, elapsed):
     bar = "█" * filled + "░" * (bar_length - filled)
     
     return f"""
-{get_status_emoji(percent)} **DOWNLOAD PROGRESS**
+{get_status_emoji(percent)} **{label} PROGRESS**
 
 {bar} {percent:.1f}%
 
@@ -510,92 +1898,525 @@ def create_download_stats(total, downloaded, elapsed):
 └ 🎯 ETA: {eta_text}
 """
 
-async def enhanced_download_with_progress(url, message, context, file_name="Video"):
+DOWNLOAD_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept': '*/*',
+    'Referer': 'https://www.terabox.com/',
+}
+
+class DownloadError(Exception):
+    pass
+
+async def probe_download(session, url):
+    """Return (total_size, supports_ranges, etag) for url; total is 0 if unknown"""
+    total, etag = 0, None
+    try:
+        async with session.head(url, headers=DOWNLOAD_HEADERS, allow_redirects=True) as resp:
+            total = int(resp.headers.get('Content-Length', 0))
+            etag = resp.headers.get('ETag')
+            if resp.status == 200 and total and resp.headers.get('Accept-Ranges', '').lower() == 'bytes':
+                return total, True, etag
+    except Exception as e:
+        print(f"HEAD probe failed: {e}")
+    
+    # Some CDNs don't answer HEAD properly; ask for the first byte instead
+    try:
+        headers = {**DOWNLOAD_HEADERS, 'Range': 'bytes=0-0'}
+        async with session.get(url, headers=headers) as resp:
+            content_range = resp.headers.get('Content-Range', '')
+            if resp.status == 206 and '/' in content_range:
+                size = content_range.rsplit('/', 1)[1]
+                if size.isdigit() and int(size) > 0:
+                    return int(size), True, resp.headers.get('ETag', etag)
+    except Exception as e:
+        print(f"Range probe failed: {e}")
+    return total, False, etag
+
+def plan_segments(total, count):
+    """Split [0, total) into at most `count` inclusive (start, end) byte ranges"""
+    count = max(1, min(count, total // SEGMENT_MIN_SIZE))
+    step = math.ceil(total / count)
+    return [(start, min(start + step, total) - 1) for start in range(0, total, step)]
+
+async def download_segment(session, url, fd, start, end, progress, index):
+    """Fetch bytes start..end into fd, resuming from the last written byte on errors"""
+    for attempt in range(1, SEGMENT_RETRIES + 1):
+        offset = start + progress[index]
+        if offset > end:
+            return
+        try:
+            headers = {**DOWNLOAD_HEADERS, 'Range': f'bytes={offset}-{end}'}
+            async with session.get(url, headers=headers) as resp:
+                if resp.status != 206:
+                    raise DownloadError(f"HTTP {resp.status} for range {offset}-{end}")
+                async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    # Positioned writes let segments share one preallocated file;
+                    # they run in a thread so disk stalls don't block the event loop
+                    await asyncio.to_thread(os.pwrite, fd, chunk, offset)
+                    offset += len(chunk)
+                    progress[index] += len(chunk)
+            if offset > end:
+                return
+            raise DownloadError(f"segment {index} ended early at byte {offset}")
+        except Exception as e:
+            print(f"❌ Segment {index} attempt {attempt}/{SEGMENT_RETRIES}: {e}")
+            if attempt == SEGMENT_RETRIES:
+                raise
+            retries.inc(operation="download_segment")
+            await asyncio.sleep(random.uniform(1, 3))
+
+def partial_paths(resume_key):
+    """Return (data_path, state_path) for a resumable download"""
+    name = hashlib.sha1(resume_key.encode()).hexdigest()
+    return os.path.join(PARTIAL_DIR, f"{name}.part"), os.path.join(PARTIAL_DIR, f"{name}.json")
+
+def load_partial_state(state_path, data_path, url, total, etag):
+    """Return saved [(start, end)] segments and progress if they match this file"""
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+        if not os.path.exists(data_path) or state['total'] != total:
+            return None, None
+        # Re-resolved links get a new URL, so the ETag is what identifies the file
+        if not ((etag and state.get('etag') == etag) or state['url'] == url):
+            return None, None
+        segments = [tuple(seg) for seg in state['segments']]
+        return segments, list(state['done'])
+    except FileNotFoundError:
+        return None, None
+    except Exception as e:
+        print(f"Ignoring unreadable partial state {state_path}: {e}")
+        return None, None
+
+def save_partial_state(state_path, url, total, etag, segments, progress):
+    """Write the sidecar atomically (blocking; call it through asyncio.to_thread)"""
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'url': url, 'total': total, 'etag': etag, 'segments': segments, 'done': progress}, f)
+    os.replace(tmp_path, state_path)
+
+def cleanup_partials():
+    """Delete partial downloads nobody resumed within PARTIAL_MAX_AGE"""
+    if not os.path.isdir(PARTIAL_DIR):
+        return
+    cutoff = time.time() - PARTIAL_MAX_AGE
+    for name in os.listdir(PARTIAL_DIR):
+        path = os.path.join(PARTIAL_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+async def segmented_download(session, url, temp_path, total, segments, progress, checkpoint=None):
+    """Fetch `segments` concurrently; progress[i] is bytes already present for segment i.
+    
+    checkpoint(progress_snapshot) is a blocking callable run off the event loop.
+    """
+    fd = os.open(temp_path, os.O_RDWR | os.O_CREAT)
     try:
-        timeout = aiohttp.ClientTimeout(total=300)
-        connector = aiohttp.TCPConnector(limit_per_host=5)
+        if os.fstat(fd).st_size != total:
+            os.ftruncate(fd, total)
+        tasks = [
+            asyncio.create_task(download_segment(session, url, fd, start, end, progress, i))
+            for i, (start, end) in enumerate(segments)
+        ]
         
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': '*/*',
-            'Referer': 'https://www.terabox.com/',
-        }
+        async def checkpoint_loop():
+            while True:
+                await asyncio.sleep(PARTIAL_CHECKPOINT)
+                await asyncio.to_thread(checkpoint, list(progress))
         
-        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
-            async with session.get(url, headers=headers) as response:
-                if response.status != 200:
-                    await message.edit_text(f"❌ Download failed: HTTP {response.status}")
-                    return None
-                
-                total = int(response.headers.get('content-length', 0))
-                downloaded = 0
-                start_time = time.time()
-                last_update_time = start_time
-                
-                with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as f:
-                    temp_path = f.name
-                
-                file_icon = get_file_icon(file_name)
-                
-                await message.edit_text(
-                    f"{file_icon} **STARTING DOWNLOAD**\n\n"
-                    f"📁 {file_name}\n"
-                    f"📦 Total Size: {format_size(total)}\n"
-                    f"⏳ Preparing...\n\n"
-                    f"{CREDIT}"
-                )
-                
-                async with aiofiles.open(temp_path, 'wb') as f:
-                    chunk_size = 1024 * 512
-                    
-                    async for chunk in response.content.iter_chunked(chunk_size):
-                        if chunk:
-                            await f.write(chunk)
-                            downloaded += len(chunk)
-                            
-                            current_time = time.time()
-                            elapsed = current_time - start_time
-                            
-                            if current_time - last_update_time >= 2 or (downloaded/total*100) - (downloaded-len(chunk))/total*100 >= 5:
-                                last_update_time = current_time
-                                
-                                stats = create_download_stats(total, downloaded, elapsed)
-                                
-                                try:
-                                    await message.edit_text(
-                                        f"{stats}\n"
-                                        f"🔗 Source: Terabox\n"
-                                        f"👤 User: {message.chat.title or 'Group'}\n\n"
-                                        f"{CREDIT}"
-                                    )
-                                except:
-                                    pass
-                
-                total_time = time.time() - start_time
-                avg_speed = total / total_time if total_time > 0 else 0
-                
-                if avg_speed > 1024*1024:
-                    final_speed = f"{avg_speed/(1024*1024):.1f} MB/s"
-                else:
-                    final_speed = f"{avg_speed/1024:.1f} KB/s"
-                
-                await message.edit_text(
-                    f"✅ **DOWNLOAD COMPLETE**\n\n"
-                    f"🎬 File: {file_name}\n"
-                    f"📦 Size: {format_size(total)}\n"
-                    f"⏱️ Time: {format_time(total_time)}\n"
-                    f"⚡ Avg Speed: {final_speed}\n"
-                    f"📤 Status: Ready for Telegram Upload\n\n"
-                    f"{CREDIT}"
-                )
-                
-                return temp_path
-                
+        saver = asyncio.create_task(checkpoint_loop()) if checkpoint else None
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if saver:
+                saver.cancel()
+                await asyncio.gather(saver, return_exceptions=True)
+                await asyncio.to_thread(checkpoint, list(progress))
+    finally:
+        os.close(fd)
+
+async def single_stream_download(session, url, temp_path, progress):
+    progress.append(0)
+    async with session.get(url, headers=DOWNLOAD_HEADERS) as response:
+        if response.status != 200:
+            raise DownloadError(f"HTTP {response.status}")
+        async with aiofiles.open(temp_path, 'wb') as f:
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                if chunk:
+                    await f.write(chunk)
+                    progress[0] += len(chunk)
+
+async def report_download_progress(message, file_name, total, progress, start_time):
+    """Push download stats to the progress renderer once a second"""
+    while True:
+        await asyncio.sleep(1)
+        downloaded = sum(progress)
+        
+        stats = create_download_stats(total, downloaded, time.time() - start_time)
+        if len(progress) > 1:
+            stats += f"🧩 Segments: {len(progress)} parallel\n"
+        
+        progress_renderer.update(
+            message,
+            f"{stats}\n"
+            f"🔗 Source: Terabox\n"
+            f"👤 User: {message.chat.title or 'Group'}\n\n"
+            f"{CREDIT}"
+        )
+
+def resume_hint(resumable):
+    return "\n\n♻️ Send the link again to resume this download" if resumable else ""
+
+async def enhanced_download_with_progress(url, message, context, file_name="Video", resume_key=None, probe=None):
+    """Download url to a local file and return its path, or None on failure.
+    
+    When the CDN supports ranges, the partial file and a state sidecar are
+    kept on failure and picked up again by the next call with the same
+    resume_key (defaults to the URL). probe is an earlier probe_download()
+    result for url, if there is one.
+    """
+    temp_path = state_path = None
+    resumable = False
+    try:
+        session = await get_http_session()
+        total, resumable, etag = probe or await probe_download(session, url)
+        
+        os.makedirs(PARTIAL_DIR, exist_ok=True)
+        temp_path, state_path = partial_paths(resume_key or url)
+        
+        segments = progress = None
+        if resumable:
+            segments, progress = load_partial_state(state_path, temp_path, url, total, etag)
+        resumed = sum(progress) if progress else 0
+        if not segments:
+            count = DOWNLOAD_SEGMENTS if total >= 2 * SEGMENT_MIN_SIZE else 1
+            segments = plan_segments(total, count) if resumable else [(0, total - 1)]
+            progress = [0] * len(segments)
+        
+        file_icon = get_file_icon(file_name)
+        
+        await progress_renderer.finish(
+            message,
+            f"{file_icon} **{'RESUMING' if resumed else 'STARTING'} DOWNLOAD**\n\n"
+            f"📁 {file_name}\n"
+            f"📦 Total Size: {format_size(total)}\n"
+            + (f"♻️ Already Downloaded: {format_size(resumed)}\n" if resumed else "")
+            + f"⏳ Preparing...\n\n"
+            f"{CREDIT}"
+        )
+        
+        start_time = time.time()
+        reporter = asyncio.create_task(report_download_progress(message, file_name, total, progress, start_time))
+        try:
+            if resumable:
+                checkpoint = lambda done: save_partial_state(state_path, url, total, etag, segments, done)
+                await segmented_download(session, url, temp_path, total, segments, progress, checkpoint)
+            else:
+                progress.clear()
+                await single_stream_download(session, url, temp_path, progress)
+        finally:
+            reporter.cancel()
+        
+        if resumable:
+            os.remove(state_path)
+        
+        total = sum(progress)
+        total_time = time.time() - start_time
+        avg_speed = (total - resumed) / total_time if total_time > 0 else 0
+        record_throughput('download', total - resumed, total_time)
+        
+        if avg_speed > 1024*1024:
+            final_speed = f"{avg_speed/(1024*1024):.1f} MB/s"
+        else:
+            final_speed = f"{avg_speed/1024:.1f} KB/s"
+        
+        await progress_renderer.finish(
+            message,
+            f"✅ **DOWNLOAD COMPLETE**\n\n"
+            f"🎬 File: {file_name}\n"
+            f"📦 Size: {format_size(total)}\n"
+            f"⏱️ Time: {format_time(total_time)}\n"
+            f"⚡ Avg Speed: {final_speed}\n"
+            f"📤 Status: Ready for Telegram Upload\n\n"
+            f"{CREDIT}"
+        )
+        
+        return temp_path
+    
+    except DownloadError as e:
+        await progress_renderer.finish(message, f"❌ Download failed: {e}" + resume_hint(resumable))
     except Exception as e:
-        await message.edit_text(f"❌ Download error: {str(e)[:100]}")
+        await progress_renderer.finish(message, f"❌ Download error: {str(e)[:100]}" + resume_hint(resumable))
+    
+    # Keep resumable partials for the next attempt; cleanup_partials() expires them
+    if not resumable and temp_path and os.path.exists(temp_path):
+        os.remove(temp_path)
+    return None
+
+# ---------- TRANSFER SCHEDULER ----------
+class NotEnoughDisk(Exception):
+    pass
+
+class TransferScheduler:
+    """Admits transfers under global and per-user concurrency limits.
+    
+    Waiting jobs are queued per group and served round-robin so one busy
+    group can't starve the others. A job is only admitted when its size
+    fits in free temp space next to the transfers already running.
+    """
+    
+    def __init__(self, max_active, max_per_user, disk_reserve):
+        self.max_active = max_active
+        self.max_per_user = max_per_user
+        self.disk_reserve = disk_reserve
+        self.queues = OrderedDict()  # group key -> deque of waiting jobs
+        self.active = []
+        self.completed = 0
+        self.served = {}  # group key -> dispatch counter when it was last served
+        self.dispatched = 0
+    
+    @property
+    def waiting(self):
+        return sum(len(queue) for queue in self.queues.values())
+    
+    def free_disk(self):
+        os.makedirs(PARTIAL_DIR, exist_ok=True)
+        reserved = sum(job['size'] for job in self.active)
+        return shutil.disk_usage(PARTIAL_DIR).free - reserved - self.disk_reserve
+    
+    @asynccontextmanager
+    async def slot(self, user_id, group_key, size=0, on_position=None):
+        """Wait for a transfer slot; on_position(n) is awaited as the queue moves"""
+        job = {
+            'user_id': user_id,
+            'group': group_key,
+            'size': size or 0,
+            'admitted': asyncio.get_running_loop().create_future(),
+            'on_position': on_position,
+            'position': None,
+        }
+        self.queues.setdefault(group_key, deque()).append(job)
+        self._dispatch()
+        
+        try:
+            await job['admitted']
+        except asyncio.CancelledError:
+            if job in self.active:
+                self._release(job)
+            else:
+                self._remove_waiting(job)
+                self._dispatch()
+            raise
+        
+        try:
+            yield
+        finally:
+            self._release(job)
+    
+    def _release(self, job):
+        self.active.remove(job)
+        self.completed += 1
+        self._dispatch()
+    
+    def _remove_waiting(self, job):
+        queue = self.queues.get(job['group'])
+        if queue and job in queue:
+            queue.remove(job)
+            if not queue:
+                del self.queues[job['group']]
+    
+    def _user_active(self, user_id):
+        return sum(1 for job in self.active if job['user_id'] == user_id)
+    
+    def can_admit(self, user_id=None):
+        """True if a new job (for user_id) would start right away instead of waiting"""
+        if len(self.active) + self.waiting >= self.max_active:
+            return False
+        return user_id is None or self._user_active(user_id) < self.max_per_user
+    
+    def _group_order(self):
+        """Groups with waiting jobs, least recently served first"""
+        return sorted(self.queues, key=lambda group: self.served.get(group, 0))
+    
+    def _next_eligible(self):
+        free = self.free_disk()
+        for group in self._group_order():
+            for job in self.queues[group]:
+                if self._user_active(job['user_id']) >= self.max_per_user:
+                    continue
+                if job['size'] > free:
+                    if not self.active:
+                        # Would never fit, even with every other transfer finished
+                        self._remove_waiting(job)
+                        job['admitted'].set_exception(NotEnoughDisk(format_size(job['size'])))
+                        return self._next_eligible()
+                    continue
+                self._remove_waiting(job)
+                self.dispatched += 1
+                self.served[group] = self.dispatched
+                return job
         return None
+    
+    def _dispatch(self):
+        while len(self.active) < self.max_active:
+            job = self._next_eligible()
+            if job is None:
+                break
+            self.active.append(job)
+            job['admitted'].set_result(True)
+        self._report_positions()
+    
+    def _report_positions(self):
+        # Round-robin order: first job of every group, then the second, ...
+        queues = [self.queues[group] for group in self._group_order()]
+        position = 0
+        for depth in range(max((len(queue) for queue in queues), default=0)):
+            for queue in queues:
+                if depth < len(queue):
+                    position += 1
+                    job = queue[depth]
+                    if job['position'] != position and job['on_position']:
+                        job['position'] = position
+                        asyncio.create_task(job['on_position'](position))
+
+transfer_scheduler = TransferScheduler(MAX_TRANSFERS, MAX_TRANSFERS_PER_USER, DISK_RESERVE)
+
+# ---------- TELEGRAM FILE_ID CACHE ----------
+async def remember_video(link_key, sent_message, title, size_bytes):
+    """Remember the file_id of an uploaded video so repeats skip the transfer"""
+    media = sent_message.video or sent_message.document
+    if media is None or user_db is None:
+        return
+    record = {
+        'file_id': media.file_id,
+        'file_unique_id': media.file_unique_id,
+        'title': title,
+        'size': size_bytes,
+        'saved': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    }
+    video_ids[link_key] = record
+    try:
+        await asyncio.to_thread(write_video_id, link_key, record)
+    except Exception as e:
+        print(f"Error saving video file_id: {e}")
+
+async def forget_video(link_key):
+    video_ids.pop(link_key, None)
+    if user_db is None:
+        return
+    try:
+        await asyncio.to_thread(write_video_id, link_key, None)
+    except Exception as e:
+        print(f"Error removing video file_id: {e}")
+
+async def send_cached_video(q, context, link_key, session_data):
+    """Re-send a known video by file_id; returns False if Telegram no longer has it"""
+    cached = video_ids[link_key]
+    title = session_data.get('title') or cached['title']
+    user_info = session_data.get('user_info', {})
+    
+    try:
+        sent_message = await context.bot.send_video(
+            chat_id=q.message.chat.id,
+            video=cached['file_id'],
+            caption=video_caption(title, cached['size'], user_info),
+            supports_streaming=True
+        )
+    except BadRequest as e:
+        # The file was removed on Telegram's side; drop it and transfer again
+        print(f"♻️ Cached file_id for {link_key} rejected: {e}")
+        await forget_video(link_key)
+        return False
+    
+    print(f"⚡ Served {link_key} from file_id cache")
+    await forward_video_to_save_group(
+        context, sent_message, user_info, title,
+        format_size(cached['size']), session_data['url'], session_data.get('original_link', '')
+    )
+    await q.message.delete()
+    return True
+
+# ---------- THROUGHPUT ----------
+def record_throughput(kind, size_bytes, seconds):
+    """Remember one finished transfer ('download', 'upload' or 'stream')"""
+    if size_bytes > 0 and seconds > 0:
+        transfer_log.append((kind, size_bytes, seconds))
+        transfer_seconds.observe(seconds, kind=kind)
+        transfer_bytes.inc(size_bytes, kind=kind)
+        print(f"📈 {kind}: {format_size(size_bytes)} in {format_time(seconds)} ({format_speed(size_bytes / seconds)})")
+
+def throughput_summary():
+    parts = []
+    for kind, icon in (('download', '⬇️'), ('upload', '⬆️'), ('stream', '🔀')):
+        entries = [(size, secs) for k, size, secs in transfer_log if k == kind]
+        if entries:
+            speed = sum(size for size, _ in entries) / sum(secs for _, secs in entries)
+            parts.append(f"{icon} {format_speed(speed)} ({len(entries)})")
+    return " | ".join(parts) or "No transfers yet"
 
 # ---------- SIMPLE UPLOAD FUNCTION ----------
+def video_caption(title, size_bytes, user_info=None):
+    return (
+        f"✅ **{title}**\n\n"
+        f"📦 Size: {format_size(size_bytes)}\n"
+        f"👤 User: {user_info.get('first_name', 'User') if user_info else 'User'}\n"
+        f"⚡ Via Terabox Downloader Bot\n\n{CREDIT}"
+    )
+
+async def local_upload_to_telegram(file_path, title, message, context, user_info=None):
+    """Upload via a local Bot API server, which reads the file from disk itself"""
+    # The server names the video after the file, so expose it under the title
+    upload_dir = tempfile.mkdtemp(dir=PARTIAL_DIR)
+    upload_path = os.path.join(upload_dir, re.sub(r'[^\w .-]', '_', title)[:64] + ".mp4")
+    try:
+        os.link(file_path, upload_path)
+        return await context.bot.send_video(
+            chat_id=message.chat.id,
+            video=Path(upload_path),
+            caption=video_caption(title, os.path.getsize(file_path), user_info),
+            supports_streaming=True,
+            read_timeout=600,
+            write_timeout=600,
+            connect_timeout=600
+        )
+    finally:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+
+class CountingFileReader:
+    """Async byte source for uploads that counts what the uploader has consumed"""
+    
+    def __init__(self, path, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.sent = 0
+    
+    async def __aiter__(self):
+        async with aiofiles.open(self.path, 'rb') as f:
+            while True:
+                chunk = await f.read(self.chunk_size)
+                if not chunk:
+                    return
+                self.sent += len(chunk)
+                yield chunk
+
+async def report_upload_progress(message, title, total, reader, start_time):
+    while True:
+        await asyncio.sleep(1)
+        stats = create_download_stats(total, reader.sent, time.time() - start_time, label="UPLOAD")
+        progress_renderer.update(
+            message,
+            f"{stats}\n"
+            f"📁 {title}\n"
+            f"📤 Destination: Telegram\n\n"
+            f"{CREDIT}"
+        )
+
 async def simple_upload_to_telegram(file_path, title, message, context, user_info=None):
     try:
         size_bytes = os.path.getsize(file_path)
@@ -610,29 +2431,26 @@ async def simple_upload_to_telegram(file_path, title, message, context, user_inf
         
         start_time = time.time()
         
-        with open(file_path, "rb") as video_file:
-            sent_message = await context.bot.send_video(
-                chat_id=message.chat.id,
-                video=video_file,
-                caption=f"✅ **{title}**\n\n"
-                       f"📦 Size: {format_size(size_bytes)}\n"
-                       f"👤 User: {user_info.get('first_name', 'User') if user_info else 'User'}\n"
-                       f"⚡ Via Terabox Downloader Bot\n\n{CREDIT}",
-                supports_streaming=True,
-                read_timeout=600,
-                write_timeout=600,
-                connect_timeout=600,
-                filename=title[:64] + ".mp4"
-            )
+        if LOCAL_BOT_API_URL:
+            sent_message = await local_upload_to_telegram(file_path, title, message, context, user_info)
+        else:
+            # Streamed through a counting reader so progress reflects bytes actually sent
+            reader = CountingFileReader(file_path)
+            reporter = asyncio.create_task(report_upload_progress(message, title, size_bytes, reader, start_time))
+            try:
+                sent_message = await bot_api_send_video(
+                    context.bot, message.chat.id, reader,
+                    title[:64] + ".mp4", video_caption(title, size_bytes, user_info)
+                )
+            finally:
+                reporter.cancel()
+                await progress_renderer.finish(message)
         
         upload_time = time.time() - start_time
+        record_throughput('upload', size_bytes, upload_time)
         
         if upload_time > 0:
-            upload_speed = size_bytes / upload_time
-            if upload_speed > 1024 * 1024:
-                speed_text = f"{upload_speed/(1024*1024):.1f} MB/s"
-            else:
-                speed_text = f"{upload_speed/1024:.1f} KB/s"
+            speed_text = format_speed(size_bytes / upload_time)
         else:
             speed_text = "Very Fast"
         
@@ -641,6 +2459,136 @@ async def simple_upload_to_telegram(file_path, title, message, context, user_inf
     except Exception as e:
         return False, 0, str(e), None
 
+# ---------- STREAMING PIPELINE ----------
+async def bot_api_send_video(bot, chat_id, video, filename, caption):
+    """Call sendVideo with a streamed multipart body and return the sent Message.
+    
+    python-telegram-bot reads the whole file into memory before sending, so
+    streamed uploads talk to the Bot API directly. video is an async iterable
+    of bytes.
+    """
+    session = await get_http_session()
+    fields = {'chat_id': chat_id, 'caption': caption, 'supports_streaming': 'true'}
+    
+    with aiohttp.MultipartWriter('form-data') as form:
+        for name, value in fields.items():
+            part = form.append(str(value))
+            part.set_content_disposition('form-data', name=name)
+        part = form.append(video, {'Content-Type': 'video/mp4'})
+        part.set_content_disposition('form-data', name='video', filename=filename)
+    
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=600)
+    with telegram_request_seconds.time(method="sendVideo"):
+        try:
+            async with session.post(f"{bot.base_url}/sendVideo", data=form, timeout=timeout) as resp:
+                data = await resp.json(content_type=None)
+        except Exception:
+            telegram_errors.inc(method="sendVideo")
+            raise
+    
+    if not data.get('ok'):
+        telegram_errors.inc(method="sendVideo")
+        raise BadRequest(data.get('description', f"HTTP {resp.status}"))
+    return Message.de_json(data['result'], bot)
+
+async def stream_download(url, buffer, progress):
+    """Feed url into buffer chunk by chunk, resuming with Range after drops.
+    
+    Ends with None on success or the exception that stopped it.
+    """
+    session = await get_http_session()
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+    
+    try:
+        for attempt in range(1, SEGMENT_RETRIES + 1):
+            headers = dict(DOWNLOAD_HEADERS)
+            if progress[0]:
+                headers['Range'] = f'bytes={progress[0]}-'
+            try:
+                async with session.get(url, headers=headers, timeout=timeout) as resp:
+                    expected = 206 if progress[0] else 200
+                    if resp.status != expected:
+                        raise DownloadError(f"HTTP {resp.status}")
+                    async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        # Blocks while the upload is behind (backpressure)
+                        await buffer.put(chunk)
+                        progress[0] += len(chunk)
+                await buffer.put(None)
+                return
+            except DownloadError:
+                raise
+            except Exception as e:
+                print(f"❌ Stream attempt {attempt}/{SEGMENT_RETRIES} at byte {progress[0]}: {e}")
+                if attempt == SEGMENT_RETRIES:
+                    raise
+                retries.inc(operation="stream")
+                await asyncio.sleep(random.uniform(1, 3))
+    except Exception as e:
+        await buffer.put(e)
+
+async def drain_buffer(buffer):
+    while True:
+        item = await buffer.get()
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+async def pipelined_telegram_transfer(q, context, uid, session_data, total=0):
+    """Download a session's file while uploading it, without touching disk"""
+    direct_link = session_data['url']
+    title = session_data.get('title', 'Video')
+    user_info = session_data.get('user_info', {})
+    original_link = session_data.get('original_link', '')
+    message = q.message
+    
+    await progress_renderer.finish(
+        message,
+        f"{get_file_icon(title)} **STREAMING TO TELEGRAM**\n\n"
+        f"📁 {title}\n"
+        f"📦 Total Size: {format_size(total)}\n"
+        f"⏳ Preparing...\n\n"
+        f"{CREDIT}"
+    )
+    
+    buffer = asyncio.Queue(PIPELINE_BUFFER_CHUNKS)
+    progress = [0]
+    start_time = time.time()
+    producer = asyncio.create_task(stream_download(direct_link, buffer, progress))
+    reporter = asyncio.create_task(report_download_progress(message, title, total, progress, start_time))
+    
+    try:
+        sent_message = await bot_api_send_video(
+            context.bot, message.chat.id, drain_buffer(buffer),
+            title[:64] + ".mp4", video_caption(title, total, user_info)
+        )
+    except Exception as e:
+        error_msg = str(e)
+        if "too large" in error_msg.lower():
+            await progress_renderer.finish(message, "❌ File too large for Telegram\nUse Direct Download")
+        else:
+            await progress_renderer.finish(message, f"❌ Transfer failed: {error_msg[:100]}")
+        return
+    finally:
+        reporter.cancel()
+        producer.cancel()
+    
+    await progress_renderer.finish(message)
+    
+    size_bytes = progress[0]
+    record_throughput('stream', size_bytes, time.time() - start_time)
+    await remember_video(normalize_link(original_link or direct_link), sent_message, title, size_bytes)
+    
+    # ✅ FORWARD VIDEO AND BOTH LINKS TO SAVE GROUP
+    await forward_video_to_save_group(
+        context, sent_message, user_info, title,
+        format_size(size_bytes), direct_link, original_link
+    )
+    
+    await asyncio.sleep(2)
+    await message.delete()
+
 # ---------- HANDLE TEXT MESSAGES (FOR DM) ----------
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text messages in private chat for direct Terabox links"""
@@ -656,12 +2604,13 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
     if not is_subscribed:
         return
     
-    # Check if message contains a Terabox link
-    terabox_domains = ['terabox.com', 'terabox.app', 'teraboxapp.com', 'teraboxurl.com', '1024tera.com', '1024tera.co', '1024terabox.com', '1024-terabox.com', 'mirrobox.com', 'nephobox.com', 'freeterabox.com', '4funbox.com', '4funbox.co', 'momerybox.com', 'tibibox.com', 'terabox.fun', 'terabox.link', 'teraboxshare.com', 'teraboxsharefile.com', 'teraboxlink.com', 'terasharelink.com', 'terasharefile.com', 'terashareus.com', 'gibibox.com', 'pebibox.com', 'fancybox.in', 'bestclouddrive.com', '4funbox.in', 'teraboxfree.com', 'terabox.club', 'terabox.click']
-    is_terabox_link = any(domain in message_text.lower() for domain in terabox_domains)
+    # Pick the share links out of the message; several links become a batch
+    links = extract_links(message_text)
     
-    if is_terabox_link:
-        await process_terabox_link(update, context, message_text, is_private=True)
+    if len(links) > 1:
+        await process_terabox_batch(update, context, links)
+    elif links:
+        await process_terabox_link(update, context, links[0], is_private=True)
 
 # ---------- COMMANDS ----------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -715,8 +2664,41 @@ async def genny(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("📌 **Usage:** /genny <terabox-link>\n\nExample: /genny https://terabox.com/s/...")
         return
     
-    original_link = context.args[0].strip()
-    await process_terabox_link(update, context, original_link, is_private=False)
+    links = extract_links(" ".join(context.args))
+    if not links:
+        await update.message.reply_text("❌ **Invalid Terabox link**\n\n📌 **Usage:** /genny <terabox-link>\n\nExample: /genny https://terabox.com/s/...")
+        return
+    
+    if len(links) > 1:
+        # Same handling as /batch and multi-link DMs
+        await process_terabox_batch(update, context, links)
+        return
+    
+    await process_terabox_link(update, context, links[0], is_private=False)
+
+async def batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # FIRST CHECK SUBSCRIPTION - ALWAYS
+    is_subscribed = await check_and_require_subscription(update, context)
+    if not is_subscribed:
+        return
+    
+    if update.message.chat.type != "private":
+        if not allowed(update):
+            deny(update)
+            return
+    
+    links = extract_links(update.message.text)
+    if not links:
+        await update.message.reply_text(
+            f"📌 **Usage:** /batch <link> <link> ...\n\n"
+            f"Up to {BATCH_MAX_LINKS} Terabox links, separated by spaces or new lines."
+        )
+        return
+    
+    if len(links) == 1:
+        await process_terabox_link(update, context, links[0], is_private=update.message.chat.type == "private")
+    else:
+        await process_terabox_batch(update, context, links)
 
 # ---------- CALLBACK HANDLER ----------
 async def buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -732,7 +2714,7 @@ async def buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await q.answer("This button is not for you!", show_alert=True)
             return
         
-        is_subscribed = await check_and_require_subscription(update, context, user_id)
+        is_subscribed = await check_and_require_subscription(update, context, user_id, refresh=True)
         if is_subscribed:
             await q.edit_message_text(
                 f"✅ **Subscription Verified!**\n\n"
@@ -745,53 +2727,181 @@ async def buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not q.data.startswith("tg_"):
         return
 
-    uid = int(q.data.split("_")[1])
+    # tg_<uid> for single links, tg_<uid>_<i> for file i of a batch
+    parts = q.data.split("_")
+    uid = int(parts[1])
+    in_batch = len(parts) > 2
+    session_key = f"{uid}:{parts[2]}" if in_batch else uid
     
     if uid != user_id:
         await q.answer("This download link is not for you!", show_alert=True)
         return
     
-    if uid not in sessions:
-        await q.edit_message_text("⚠️ Session expired. Please generate link again.")
+    async def session_expired():
+        text = "⚠️ Session expired. Please generate link again."
+        if in_batch:
+            # Keep the batch message and its other buttons
+            await q.message.reply_text(text)
+        else:
+            await q.edit_message_text(text)
+    
+    if not await state.has_session(session_key):
+        await session_expired()
         return
 
     is_subscribed = await check_and_require_subscription(update, context, user_id)
     if not is_subscribed:
         return
     
-    session_data = sessions.pop(uid)
+    session_data = await state.pop_session(session_key)
+    if session_data is None:
+        # Expired while the subscription was being checked
+        await session_expired()
+        return
     direct_link = session_data['url']
     title = session_data.get('title', 'Video')
     file_size = session_data.get('size', 'Unknown')
-    user_info = session_data.get('user_info', {})
-    original_link = session_data.get('original_link', '')
+    
+    # ✅ ALREADY ON TELEGRAM? RE-SEND BY FILE_ID
+    if in_batch:
+        # Progress goes to its own message so the batch buttons stay usable
+        status = await q.message.reply_text(f"🎬 **{title}**\n📦 {file_size}")
+        q = CallbackQuery(q.id, q.from_user, q.chat_instance, message=status, data=q.data)
+        q.set_bot(context.bot)
+    
+    link_key = normalize_link(session_data.get('original_link') or direct_link)
+    if link_key in video_ids and await send_cached_video(q, context, link_key, session_data):
+        return
     
     # ✅ FIRST CHECK FILE SIZE BEFORE DOWNLOADING
+    # Same probe as the downloader (CDN headers, Range fallback); its result is
+    # kept in the session so the download doesn't probe again
+    size_bytes = 0
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.head(direct_link) as resp:
-                content_length = resp.headers.get('Content-Length')
-                if content_length:
-                    size_bytes = int(content_length)
-                    size_mb = size_bytes / (1024 * 1024)
-                    
-                    # Check if file is larger than 100MB
-                    if size_mb > 99999:
-                        await q.edit_message_text(
-                            f"❌ **File Too Large**\n\n"
-                            f"📁 Title: {title}\n"
-                            f"📦 Size: {format_size(size_bytes)}\n\n"
-                            f"⚠️ Telegram limits: Max 300MB\n"
-                            f"📥 Use Direct Download link instead.\n\n"
-                            f"{CREDIT}"
-                        )
-                        return
-    except:
-        pass  # If we can't check size, continue with download
-    
-    await q.edit_message_text(f"🎬 **STARTING DOWNLOAD**\n\n📁 {title}\n📦 {file_size}")
-    
-    file_path = await enhanced_download_with_progress(direct_link, q.message, context, title)
+        session = await get_http_session()
+        probe = await asyncio.wait_for(probe_download(session, direct_link), timeout=30)
+        session_data['probe'] = probe
+        size_bytes = probe[0]
+    except Exception as e:
+        print(f"Size probe failed, admitting without a size: {e}")
+    
+    # Check if file is larger than the upload limit
+    if size_bytes / (1024 * 1024) > UPLOAD_LIMIT_MB:
+        await q.edit_message_text(
+            f"❌ **File Too Large**\n\n"
+            f"📁 Title: {title}\n"
+            f"📦 Size: {format_size(size_bytes)}\n\n"
+            f"⚠️ Telegram limits: Max {UPLOAD_LIMIT_MB}MB\n"
+            f"📥 Use Direct Download link instead.\n\n"
+            f"{CREDIT}"
+        )
+        return
+    
+    if isinstance(state, TransferQueue):
+        # Show QUEUED before the job is visible: any worker with a free slot can
+        # take it straight away (see transfer_consumer), and its first status
+        # edit must not be overwritten by ours
+        await progress_renderer.finish(q.message, f"⏳ **QUEUED FOR DOWNLOAD**\n\n📁 {title}\n📦 {file_size}\n\n{CREDIT}")
+        await state.push_transfer({'query': q.to_dict(), 'uid': uid, 'session': session_data, 'size': size_bytes})
+        return
+    
+    # Run the transfer outside the handler so this user's next updates aren't
+    # held behind it by the per-user ordering in PerUserUpdateProcessor
+    context.application.create_task(scheduled_transfer(q, context, uid, session_data, size_bytes), update=update)
+
+async def scheduled_transfer(q, context, uid, session_data, size_bytes=0):
+    """Wait for a transfer slot, then run the Telegram transfer"""
+    direct_link = session_data['url']
+    title = session_data.get('title', 'Video')
+    file_size = session_data.get('size', 'Unknown')
+    
+    async def show_queue_position(position):
+        progress_renderer.update(
+            q.message,
+            f"⏳ **QUEUED FOR DOWNLOAD**\n\n"
+            f"📁 {title}\n"
+            f"📦 {file_size}\n\n"
+            f"🔢 Queue Position: {position}\n"
+            f"⚙️ Active Transfers: {len(transfer_scheduler.active)}/{transfer_scheduler.max_active}\n\n"
+            f"{CREDIT}"
+        )
+    
+    group_key = q.message.chat.id if q.message.chat.id in ALLOWED_GROUPS else "private"
+    disk_bytes = 0 if PIPELINE_UPLOADS else size_bytes  # pipelined transfers never hit disk
+    try:
+        async with transfer_scheduler.slot(uid, group_key, disk_bytes, show_queue_position):
+            if PIPELINE_UPLOADS:
+                await pipelined_telegram_transfer(q, context, uid, session_data, size_bytes)
+            else:
+                await telegram_transfer(q, context, uid, session_data)
+    except NotEnoughDisk as e:
+        await progress_renderer.finish(
+            q.message,
+            f"❌ **Not Enough Server Space**\n\n"
+            f"📁 Title: {title}\n"
+            f"📦 Size: {e}\n\n"
+            f"📥 Use Direct Download link:\n{direct_link}\n\n"
+            f"{CREDIT}"
+        )
+
+async def run_shared_transfer(app, context, job):
+    try:
+        q = CallbackQuery.de_json(job['query'], app.bot)
+        await scheduled_transfer(q, context, job['uid'], job['session'], job['size'])
+    except Exception as e:
+        print(f"❌ Shared transfer failed: {e}")
+
+async def transfer_consumer(app):
+    """Run transfers from the shared queue (Redis backend) on this worker.
+    
+    Jobs are only taken while this worker has a free slot, and jobs of a
+    user already at MAX_TRANSFERS_PER_USER here go back to the end of the
+    queue, so one user's presses can't hold this worker's slots while
+    other users' jobs wait in Redis.
+    """
+    context = CallbackContext(app)
+    deferred = set()  # jobs sent to the back of the queue since the last admission
+    while True:
+        try:
+            if not transfer_scheduler.can_admit():
+                await asyncio.sleep(0.5)
+                continue
+            job = await state.pop_transfer(timeout=5)
+            if job is None:
+                continue
+            if not transfer_scheduler.can_admit(job['uid']):
+                await state.push_transfer(job)
+                marker = json.dumps(job, sort_keys=True)
+                if marker in deferred:
+                    # Went round the queue without finding anything to start
+                    deferred.clear()
+                    await asyncio.sleep(0.5)
+                deferred.add(marker)
+                continue
+            deferred.clear()
+            # Admitted right away; the consumer goes straight back to the queue
+            app.create_task(run_shared_transfer(app, context, job))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"❌ Shared transfer queue error: {e}")
+            await asyncio.sleep(1)
+
+async def telegram_transfer(q, context, uid, session_data):
+    """Download a session's file and upload it to the chat"""
+    direct_link = session_data['url']
+    title = session_data.get('title', 'Video')
+    file_size = session_data.get('size', 'Unknown')
+    user_info = session_data.get('user_info', {})
+    original_link = session_data.get('original_link', '')
+    
+    await progress_renderer.finish(q.message, f"🎬 **STARTING DOWNLOAD**\n\n📁 {title}\n📦 {file_size}")
+    
+    file_path = await enhanced_download_with_progress(
+        direct_link, q.message, context, title,
+        resume_key=f"{uid}:{normalize_link(original_link or direct_link)}",
+        probe=session_data.get('probe'),
+    )
     
     if not file_path:
         return
@@ -800,13 +2910,13 @@ async def buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     size_bytes = os.path.getsize(file_path)
     size_mb = size_bytes / (1024 * 1024)
     
-    # ✅ REDUCED TO 300MB LIMIT
-    if size_mb > 99999:
+    # ✅ UPLOAD LIMIT (higher with a local Bot API server)
+    if size_mb > UPLOAD_LIMIT_MB:
         await q.edit_message_text(
             f"❌ **File Too Large for Telegram**\n\n"
             f"📁 Title: {title}\n"
             f"📦 Size: {format_size(size_bytes)}\n\n"
-            f"⚠️ Telegram limit: 300MB\n"
+            f"⚠️ Telegram limit: {UPLOAD_LIMIT_MB}MB\n"
             f"📥 Use Direct Download link:\n{direct_link}\n\n"
             f"{CREDIT}"
         )
@@ -819,6 +2929,8 @@ async def buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         
         if success and sent_message:
+            await remember_video(normalize_link(original_link or direct_link), sent_message, title, size_bytes)
+            
             # ✅ FORWARD VIDEO AND BOTH LINKS TO SAVE GROUP
             await forward_video_to_save_group(
                 context, sent_message, user_info, title, 
@@ -834,7 +2946,7 @@ async def buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         error_msg = str(e)
         if "File too large" in error_msg:
-            await q.edit_message_text("❌ File too large for Telegram (300MB limit)\nUse Direct Download")
+            await q.edit_message_text(f"❌ File too large for Telegram ({UPLOAD_LIMIT_MB}MB limit)\nUse Direct Download")
         elif "timed out" in error_msg:
             await q.edit_message_text("❌ Upload timeout! Slow internet connection.\nTry Direct Download")
         else:
@@ -854,10 +2966,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📌 **Available Commands:**\n"
         "/start - Start the bot\n"
         "/genny <link> - Download terabox link (in groups)\n"
+        f"/batch <links> - Get up to {BATCH_MAX_LINKS} links at once\n"
         "/help - Show this help message\n"
         "/info - Show your information\n\n"
         "📌 **How to use:**\n"
-        "**In Private Chat:** Simply send Terabox links directly\n"
+        "**In Private Chat:** Simply send Terabox links directly (several at once work too)\n"
         "**In Groups:** Use /genny <terabox-link>\n\n"
         "📌 **Example Links:**\n"
         "• https://terabox.com/s/...\n"
@@ -879,8 +2992,8 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"📛 Name: {user.first_name} {user.last_name or ''}\n"
         f"🔗 Username: @{user.username or 'N/A'}\n\n"
         f"📊 **Bot Stats:**\n"
-        f"👥 Total Users: {len(user_data)}\n"
-        f"🔄 Active Sessions: {len(sessions)}\n\n"
+        f"👥 Total Users: {await state.count_users()}\n"
+        f"🔄 Active Sessions: {await state.count_sessions()}\n\n"
         f"📌 **Subscription Status:** ✅ Subscribed\n\n"
         f"{CREDIT}"
     )
@@ -896,12 +3009,27 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ This command is for admins only.")
         return
     
+    pool_in_use, pool_idle = http_pool_stats()
+    backend_stats = await state.stats()
     stats_text = (
         f"📊 **BOT STATISTICS**\n\n"
-        f"👥 Total Users: {len(user_data)}\n"
-        f"🔄 Active Sessions: {len(sessions)}\n"
-        f"⏰ Cooldown Users: {len(user_last)}\n"
-        f"💾 Save Group: {SAVE_GROUP_ID}\n\n"
+        f"🗄️ State Backend: {type(state).__name__}\n"
+        f"👥 Total Users: {await state.count_users()}\n"
+        f"🔄 Active Sessions: {backend_stats['sessions']}\n"
+        f"⏰ Cooldown Users: {backend_stats['cooldowns']}\n"
+        f"✏️ Progress Edits: {progress_renderer.edits} sent | {progress_renderer.skipped} skipped | "
+        f"{progress_renderer.flood_waits} flood waits | {progress_renderer.rate:.1f}/s budget\n"
+        f"📈 Throughput: {throughput_summary()}\n"
+        f"⚙️ Transfers: {len(transfer_scheduler.active)} active | {transfer_scheduler.waiting} queued | {transfer_scheduler.completed} done\n"
+        f"🎞️ Cached Videos: {len(video_ids)}\n"
+        f"🌐 HTTP Pool: {pool_in_use} in use / {pool_idle} idle | {http_stats['requests']} requests, "
+        f"{http_stats['reused_connections']} reused / {http_stats['new_connections']} new conns, "
+        f"DNS {http_stats['dns_hits']} hits / {http_stats['dns_misses']} misses\n"
+        f"⚡ Link Cache: {backend_stats['links']} links | {link_stats['hits']} hits / {link_stats['misses']} misses\n"
+        f"🛰️ Resolvers: {' | '.join(endpoint.describe() for endpoint in resolver_pool.endpoints)}\n"
+        f"💾 Save Group: {SAVE_GROUP_ID}\n"
+        f"📮 Save Queue: {save_queue.queue.qsize()} pending | {save_queue.sent} sent | "
+        f"{save_queue.spilled} spilled | {save_queue.dropped} dropped | {save_queue.failed} failed\n\n"
         f"📢 Channel: {CHANNEL_USERNAME}\n"
         f"👥 Group: {GROUP_USERNAME}\n\n"
         f"✅ **Allowed Groups:**\n"
@@ -940,18 +3068,180 @@ async def links_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         await send_links_to_save_group(context, user_info, original_link, direct_link, title, "Unknown")
-        await update.message.reply_text("✅ Links sent to save group!")
+        await update.message.reply_text("✅ Links queued for save group!")
     except Exception as e:
         await update.message.reply_text(f"❌ Error: {e}")
 
 # ---------- MAIN FUNCTION ----------
-def main():
-    load_user_data()
+async def post_init(app):
+    """Open shared resources and start background workers"""
+    await open_http_session()
+    await start_metrics_server()
+    cleanup_partials()
+    background_tasks.append(asyncio.create_task(user_flush_loop()))
+    background_tasks.append(asyncio.create_task(save_queue.run(app.bot)))
+    background_tasks.append(asyncio.create_task(progress_renderer.run()))
+    background_tasks.append(asyncio.create_task(sweep_loop()))
+    if SAVE_DIGEST:
+        background_tasks.append(asyncio.create_task(save_digest.run()))
+    if isinstance(state, TransferQueue):
+        background_tasks.append(asyncio.create_task(transfer_consumer(app)))
+
+async def post_shutdown(app):
+    """Stop background workers and release shared resources"""
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    
+    save_digest.flush()
+    save_queue.spill_pending()
+    await flush_user_data()
+    if user_db is not None:
+        user_db.close()
+    await state.close()
+    await close_http_session()
+    await stop_metrics_server()
+
+# ---------- UPDATE PROCESSING ----------
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Runs updates concurrently while keeping each user's updates in order.
+    
+    Updates wait for their user's turn before taking one of the
+    max_concurrent_updates global slots, so a queue of one user's updates
+    can't starve everybody else.
+    """
+    
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}  # sequencing key -> [asyncio.Lock, number of updates using it]
+    
+    @staticmethod
+    def sequence_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return 'user', update.effective_user.id
+            if update.effective_chat:
+                return 'chat', update.effective_chat.id
+        return None
+    
+    async def process_update(self, update, coroutine):
+        key = self.sequence_key(update)
+        if key is None:
+            return await super().process_update(update, coroutine)
+        
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+    
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+# ---------- WEBHOOK SERVER ----------
+def create_webhook_app(app, secret):
+    """aiohttp app that validates Telegram webhook calls and queues the updates"""
+    async def receive_update(request):
+        # Only Telegram knows the secret, so this rejects forged updates
+        if not secrets.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), secret):
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), app.bot)
+        except Exception as e:
+            print(f"❌ Bad webhook payload: {e}")
+            return web.Response(status=400)
+        # Answer right away; the application processes the queue concurrently
+        await app.update_queue.put(update)
+        return web.Response(text="ok")
+    
+    async def health(request):
+        return web.Response(text="ok")
+    
+    web_app = web.Application()
+    web_app.router.add_post(WEBHOOK_PATH, receive_update)
+    web_app.router.add_get("/healthz", health)
+    return web_app
+
+async def run_webhook(app):
+    """Serve updates over HTTP until SIGINT/SIGTERM, then shut down cleanly"""
+    secret = WEBHOOK_SECRET
+    if not secret:
+        if not WEBHOOK_URL:
+            # Without a secret anyone who can reach PORT could forge updates
+            raise SystemExit("❌ BOT_MODE=webhook needs WEBHOOK_SECRET (or WEBHOOK_URL, so one can be generated)")
+        secret = secrets.token_urlsafe(32)
+        print("🔐 No WEBHOOK_SECRET set, generated one for this run")
+    
+    # run_polling calls post_init/post_shutdown itself; here we manage the lifecycle
+    await app.initialize()
+    await post_init(app)
+    await app.start()
+    
+    runner = web.AppRunner(create_webhook_app(app, secret))
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", PORT).start()
+    print(f"🌐 Webhook listening on :{PORT}{WEBHOOK_PATH}")
+    
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(
+            url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=secret,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES
+        )
+        print(f"✅ Webhook set to {WEBHOOK_URL}{WEBHOOK_PATH}")
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
     
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    try:
+        await stop_event.wait()
+    finally:
+        print("🛑 Shutting down webhook server...")
+        # Stop accepting requests first, then let queued updates finish
+        await runner.cleanup()
+        await app.stop()
+        await app.shutdown()
+        await post_shutdown(app)
+
+def build_application():
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .request(MeteredRequest(connection_pool_size=256))
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if LOCAL_BOT_API_URL:
+        builder = (
+            builder
+            .base_url(f"{LOCAL_BOT_API_URL}/bot")
+            .base_file_url(f"{LOCAL_BOT_API_URL}/file/bot")
+            .local_mode(True)
+        )
+    elif BOT_API_URL:
+        builder = builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+    if BOT_MODE == "webhook":
+        builder = builder.updater(None)
+    app = builder.build()
     
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("genny", genny))
+    app.add_handler(CommandHandler("batch", batch))
     app.add_handler(CommandHandler("help", help_command))
     app.add_handler(CommandHandler("info", info_command))
     app.add_handler(CommandHandler("stats", stats_command))
@@ -961,6 +3251,12 @@ def main():
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
     
     app.add_handler(CallbackQueryHandler(buttons))
+    return app
+
+def main():
+    load_user_data()
+    
+    app = build_application()
     
     print("=" * 60)
     print("🤖 TERABOX DOWNLOADER BOT STARTED")
@@ -981,12 +3277,18 @@ def main():
     print("=" * 60)
     print(f"✅ Users MUST join channel & group to use bot")
     print(f"✅ Allowed Groups: {len(ALLOWED_GROUPS)}")
+    print(f"📤 Bot API: {LOCAL_BOT_API_URL or BOT_API_URL or 'api.telegram.org'}{' (local mode)' if LOCAL_BOT_API_URL else ''} (upload limit {UPLOAD_LIMIT_MB}MB)")
     print(f"👤 Loaded Users: {len(user_data)}")
+    print(f"📡 Update Mode: {BOT_MODE}")
+    print(f"🗄️ State Backend: {type(state).__name__}")
     print("=" * 60)
     print("✅ Bot is ready to use!")
     print("=" * 60)
     
-    app.run_polling()
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,23 @@
+from javacoder import extract_links, normalize_link
+
+
+def test_extracts_share_links_in_order_without_duplicates():
+    text = (
+        "grab https://terabox.com/s/1abc, then www.1024terabox.com/s/1xyz and "
+        "http://foo.teraboxapp.com/sharing/link?surl=abc."
+    )
+    assert extract_links(text) == ["https://terabox.com/s/1abc", "https://www.1024terabox.com/s/1xyz"]
+
+
+def test_skips_lookalike_hosts_and_bare_pages():
+    text = "terabox.com.evil.org/s/1a xterabox.com/s/1b user@terabox.com/s/1c terabox.com file.txt"
+    assert extract_links(text) == []
+
+
+def test_finds_links_inside_other_urls_and_strips_punctuation():
+    assert extract_links("example.org/go/terabox.com/s/1x") == ["https://terabox.com/s/1x"]
+    assert extract_links("see (terabox.app/s/1k)!") == ["https://terabox.app/s/1k"]
+
+
+def test_normalize_link_maps_share_forms_to_one_key():
+    assert normalize_link("https://terabox.com/s/1abc") == normalize_link("teraboxapp.com/sharing/link?surl=abc")
@@ -0,0 +1,52 @@
+import asyncio
+from types import SimpleNamespace
+
+from javacoder import ProgressRenderer
+
+
+class FakeMessage:
+    def __init__(self, message_id, delay=0):
+        self.chat = SimpleNamespace(id=1)
+        self.message_id = message_id
+        self.delay = delay
+        self.texts = []
+
+    async def edit_text(self, text, **kwargs):
+        await asyncio.sleep(self.delay)
+        self.texts.append(text)
+
+
+def test_finish_forgets_message_state():
+    async def scenario():
+        renderer = ProgressRenderer(max_rate=1000, min_interval=0)
+        runner = asyncio.create_task(renderer.run())
+        for i in range(500):
+            message = FakeMessage(i)
+            renderer.update(message, "⬇️ 50%")
+            if i % 2:
+                await asyncio.sleep(0.005)  # let some progress edits go out first
+            await renderer.finish(message, "✅ Done" if i % 3 else None)
+        await asyncio.sleep(0.05)
+        runner.cancel()
+        return renderer
+
+    renderer = asyncio.run(scenario())
+    assert (len(renderer.pending), len(renderer.shown), len(renderer.epochs), len(renderer.locks), len(renderer.busy)) == (0, 0, 0, 0, 0)
+
+
+def test_final_text_wins_over_in_flight_progress():
+    async def scenario():
+        renderer = ProgressRenderer(max_rate=1000, min_interval=0)
+        runner = asyncio.create_task(renderer.run())
+        message = FakeMessage(1, delay=0.05)
+        renderer.update(message, "⬇️ 50%")
+        await asyncio.sleep(0.01)  # the progress edit is now in flight
+        renderer.update(message, "⬇️ 90%")
+        await renderer.finish(message, "✅ Done")
+        await asyncio.sleep(0.1)
+        runner.cancel()
+        return renderer, message
+
+    renderer, message = asyncio.run(scenario())
+    assert message.texts == ["⬇️ 50%", "✅ Done"]
+    assert not renderer.epochs and not renderer.locks
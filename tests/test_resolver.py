@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+import javacoder
+from javacoder import LINK_NEGATIVE_TTL, NO_LINK, MemoryBackend, ResolverPool
+
+LINK = "https://terabox.com/s/abc"
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    """A two-endpoint pool whose _query answers are set per test"""
+    javacoder.link_cache._data.clear()
+    javacoder.inflight_resolves.clear()
+    pool = ResolverPool(["http://a.test/api", "http://b.test/api"])
+    monkeypatch.setattr(javacoder, "resolver_pool", pool)
+    monkeypatch.setattr(javacoder, "state", MemoryBackend())
+    monkeypatch.setattr(javacoder.random, "uniform", lambda a, b: 0)  # no retry backoff
+    return pool
+
+
+def answer_with(pool, monkeypatch, result):
+    calls = []
+
+    async def query(endpoint, link):
+        calls.append(endpoint.name)
+        endpoint.record(result is not None, 0.01)
+        return result
+
+    monkeypatch.setattr(pool, "_query", query)
+    return calls
+
+
+def test_link_found_is_cached(pool, monkeypatch):
+    answer_with(pool, monkeypatch, ("https://cdn/x", "x.mp4", 1024))
+    result = asyncio.run(javacoder.resolve_link(LINK))
+    assert result == ("https://cdn/x", "x.mp4", 1024)
+    assert javacoder.link_cache.ttl_left(javacoder.normalize_link(LINK)) > LINK_NEGATIVE_TTL
+
+
+def test_no_link_answer_is_negatively_cached(pool, monkeypatch):
+    answer_with(pool, monkeypatch, NO_LINK)
+    assert asyncio.run(javacoder.resolve_link(LINK)) == NO_LINK
+    assert 0 < javacoder.link_cache.ttl_left(javacoder.normalize_link(LINK)) <= LINK_NEGATIVE_TTL
+
+
+def test_resolver_errors_are_not_cached(pool, monkeypatch):
+    answer_with(pool, monkeypatch, None)
+    assert asyncio.run(javacoder.resolve_link(LINK)) == NO_LINK
+    assert javacoder.normalize_link(LINK) not in javacoder.link_cache
+
+
+def test_breaker_fast_fail_is_not_cached(pool, monkeypatch):
+    calls = answer_with(pool, monkeypatch, None)
+    for endpoint in pool.endpoints:
+        for _ in range(javacoder.BREAKER_FAILURES):
+            endpoint.record(False)
+    assert pool.all_open()
+
+    assert asyncio.run(javacoder.resolve_link(LINK)) == NO_LINK
+    assert calls == []
+    assert javacoder.normalize_link(LINK) not in javacoder.link_cache
+
+    # Once an endpoint recovers the same link resolves instead of hitting a stale negative entry
+    pool.endpoints[0].opened_at -= javacoder.BREAKER_COOLDOWN
+    answer_with(pool, monkeypatch, ("https://cdn/x", "x.mp4", 1024))
+    assert asyncio.run(javacoder.resolve_link(LINK))[0] == "https://cdn/x"
+
+
+def test_endpoint_losing_hedges_drops_down_the_ranking(pool, monkeypatch):
+    monkeypatch.setattr(javacoder, "HEDGE_DEFAULT_DELAY", 0.05)
+    slow, fast = pool.endpoints
+
+    async def query(endpoint, link):
+        if endpoint is slow:
+            await asyncio.sleep(60)  # hangs until the hedge wins and it is cancelled
+        endpoint.record(True, 0.01)
+        return ("https://cdn/x", "x.mp4", 1024)
+
+    monkeypatch.setattr(pool, "_query", query)
+
+    async def scenario():
+        firsts = []
+        for _ in range(3):
+            firsts.append(pool.ranked()[0])
+            assert await pool.resolve(LINK) is not None
+        return firsts
+
+    firsts = asyncio.run(scenario())
+    assert firsts[0] is slow and firsts[1:] == [fast, fast]
+    assert slow.health < 1.0
+    assert slow.percentile(0.5) >= 0.05
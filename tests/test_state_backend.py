@@ -0,0 +1,158 @@
+import asyncio
+
+import pytest
+
+import javacoder
+from javacoder import LINK_NEGATIVE_TTL, MemoryBackend, RedisBackend, TransferScheduler
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def redis_backend():
+    return RedisBackend(None, prefix="test:", client=fakeredis.FakeAsyncRedis(decode_responses=True))
+
+
+@pytest.fixture
+def memory_backend():
+    for cache in (javacoder.user_last, javacoder.sessions, javacoder.link_cache):
+        cache._data.clear()
+    return MemoryBackend()
+
+
+# ---------- COOLDOWNS ----------
+def test_redis_cooldown_is_exclusive():
+    async def scenario():
+        backend = redis_backend()
+        results = await asyncio.gather(*(backend.acquire_cooldown(42, 10) for _ in range(20)))
+        other = await backend.acquire_cooldown(43, 10)
+        return results, other
+
+    results, other = run(scenario())
+    assert results.count(True) == 1
+    assert other is True
+
+
+def test_redis_cooldown_expires():
+    async def scenario():
+        backend = redis_backend()
+        first = await backend.acquire_cooldown(42, 1)
+        await asyncio.sleep(1.1)
+        return first, await backend.acquire_cooldown(42, 1)
+
+    assert run(scenario()) == (True, True)
+
+
+def test_memory_cooldown_is_exclusive(memory_backend):
+    async def scenario():
+        return [await memory_backend.acquire_cooldown(42, 10) for _ in range(3)]
+
+    assert run(scenario()) == [True, False, False]
+
+
+# ---------- SESSIONS ----------
+def test_redis_pop_session_exactly_once():
+    async def scenario():
+        backend = redis_backend()
+        await backend.set_session("42:0", {"name": "video.mp4"}, 60)
+        results = await asyncio.gather(*(backend.pop_session("42:0") for _ in range(20)))
+        return results, await backend.has_session("42:0"), await backend.count_sessions()
+
+    results, still_there, count = run(scenario())
+    assert [r for r in results if r is not None] == [{"name": "video.mp4"}]
+    assert not still_there
+    assert count == 0
+
+
+def test_redis_count_sessions_drops_expired():
+    async def scenario():
+        backend = redis_backend()
+        await backend.set_session("1", {}, 60)
+        await backend.set_session("2", {}, 0.2)
+        before = await backend.count_sessions()
+        await asyncio.sleep(0.3)
+        return before, await backend.count_sessions()
+
+    assert run(scenario()) == (2, 1)
+
+
+def test_memory_pop_session_exactly_once(memory_backend):
+    async def scenario():
+        await memory_backend.set_session("42:0", {"name": "video.mp4"}, 60)
+        return await memory_backend.pop_session("42:0"), await memory_backend.pop_session("42:0")
+
+    assert run(scenario()) == ({"name": "video.mp4"}, None)
+
+
+# ---------- LINK CACHE ----------
+def test_redis_negative_link_ttl():
+    async def scenario():
+        backend = redis_backend()
+        await backend.set_link("terabox.com/s/abc", (None, None, None), LINK_NEGATIVE_TTL)
+        return await backend.get_link("terabox.com/s/abc"), await backend.link_ttl("terabox.com/s/abc")
+
+    cached, ttl = run(scenario())
+    assert cached == (None, None, None)
+    assert 0 < ttl <= LINK_NEGATIVE_TTL
+
+
+def test_redis_negative_link_expires():
+    async def scenario():
+        backend = redis_backend()
+        await backend.set_link("terabox.com/s/abc", (None, None, None), 1)
+        await asyncio.sleep(1.1)
+        return await backend.get_link("terabox.com/s/abc"), await backend.link_ttl("terabox.com/s/abc")
+
+    assert run(scenario()) == (None, 0)
+
+
+def test_redis_link_round_trip():
+    async def scenario():
+        backend = redis_backend()
+        await backend.set_link("terabox.com/s/abc", ("https://cdn/x", "x.mp4", 1024), 60)
+        return await backend.get_link("terabox.com/s/abc")
+
+    assert run(scenario()) == ("https://cdn/x", "x.mp4", 1024)
+
+
+# ---------- TRANSFER QUEUE ----------
+def test_redis_transfer_queue_is_fifo():
+    async def scenario():
+        backend = redis_backend()
+        for i in range(3):
+            await backend.push_transfer({"uid": i, "session": {"n": i}})
+        return [await backend.pop_transfer(timeout=1) for _ in range(3)]
+
+    jobs = run(scenario())
+    assert [job["uid"] for job in jobs] == [0, 1, 2]
+
+
+def test_redis_transfer_queue_times_out_empty():
+    assert run(redis_backend().pop_transfer(timeout=1)) is None
+
+
+def test_redis_transfer_queue_wakes_waiting_consumer():
+    async def scenario():
+        backend = redis_backend()
+        waiter = asyncio.create_task(backend.pop_transfer(timeout=5))
+        await asyncio.sleep(0.1)
+        await backend.push_transfer({"uid": 7})
+        return await waiter
+
+    assert run(scenario()) == {"uid": 7}
+
+
+# ---------- ADMISSION ----------
+def test_scheduler_can_admit_respects_limits():
+    async def scenario():
+        scheduler = TransferScheduler(max_active=2, max_per_user=1, disk_reserve=0)
+        async with scheduler.slot(1, "private"):
+            per_user = (scheduler.can_admit(1), scheduler.can_admit(2))
+            async with scheduler.slot(2, "private"):
+                full = scheduler.can_admit()
+        return per_user, full, scheduler.can_admit(1)
+
+    assert run(scenario()) == ((False, True), False, True)